@@ -1,7 +1,36 @@
+import json
 import hashlib
+import logging
+from dataclasses import dataclass, asdict
+from datetime import datetime
 from fastapi import HTTPException, Request, Depends
+from sqlalchemy import update
 from sqlalchemy.orm import Session
-from database import User, get_database_session
+from database import User, get_request_session, run_with_session, release_session_connection
+from cache_service import redis_call, principal_cache, PRINCIPAL_REDIS_TTL
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class SessionPrincipal:
+    """The user fields routes need, cached per user instead of loading the ORM entity on every request"""
+    id: int
+    name: str
+    email: str
+    is_active: bool
+    created_at: datetime = None
+
+    def to_json(self) -> str:
+        fields = asdict(self)
+        fields['created_at'] = self.created_at.isoformat() if self.created_at else None
+        return json.dumps(fields)
+
+    @classmethod
+    def from_json(cls, raw) -> "SessionPrincipal":
+        fields = json.loads(raw)
+        if fields.get('created_at'):
+            fields['created_at'] = datetime.fromisoformat(fields['created_at'])
+        return cls(**fields)
 
 def hash_user_password(password: str) -> str:
     """Hash a password - using SHA-256 for simplicity"""
@@ -11,18 +40,57 @@ def check_password(password: str, hashed_password: str) -> bool:
     """Verify password against hash"""
     return hash_user_password(password) == hashed_password
 
-def get_logged_in_user(request: Request, db: Session = Depends(get_database_session)) -> User:
+def load_user_principal(user_id: int, db: Session) -> SessionPrincipal:
+    """Load the principal columns for a user by id, without hydrating a User entity"""
+    row = db.query(User.id, User.name, User.email, User.is_active, User.created_at).filter(User.id == user_id).first()
+    if not row:
+        return None
+    return SessionPrincipal(id=row.id, name=row.name, email=row.email, is_active=bool(row.is_active),
+                            created_at=row.created_at)
+
+async def get_user_principal(user_id: int, db) -> SessionPrincipal:
+    """Resolve a principal from the local cache, then Redis, then the database"""
+    principal = principal_cache.get(user_id)
+    if principal:
+        return principal
+
+    redis_key = f"principal:{user_id}"
+    try:
+        cached = await redis_call("get", redis_key)
+        principal = SessionPrincipal.from_json(cached) if cached else None
+    except Exception as cache_error:
+        logger.warning(f"Principal cache read failed: {cache_error}")
+
+    if not principal:
+        principal = await run_with_session(db, load_user_principal, user_id)
+        # Release the connection now, so a route reading from a replica doesn't hold a primary one as well.
+        await release_session_connection(db)
+        if not principal:
+            return None
+        try:
+            await redis_call("set", redis_key, principal.to_json(), ex=PRINCIPAL_REDIS_TTL)
+        except Exception as cache_error:
+            logger.warning(f"Principal cache write failed: {cache_error}")
+
+    principal_cache.set(user_id, principal)
+    return principal
+
+async def get_logged_in_user(request: Request, db = Depends(get_request_session)) -> SessionPrincipal:
     """Get the current user from session - throws error if not logged in"""
     user_id = request.session.get("user_id")
     if not user_id:
         raise HTTPException(status_code=401, detail="You need to login first")
     
-    user = db.query(User).filter(User.id == user_id, User.is_active == True).first()
-    if not user:
+    user = await get_user_principal(user_id, db)
+    if not user or not user.is_active:
         raise HTTPException(status_code=401, detail="User account not found or inactive")
     
     return user
 
+async def get_logged_in_user_id(user: SessionPrincipal = Depends(get_logged_in_user)) -> int:
+    """Just the current user's id, for routes that need nothing else"""
+    return user.id
+
 def create_user_account(name: str, email: str, password: str, db: Session) -> User:
     """Create a new user account"""
     
@@ -44,6 +112,15 @@ def create_user_account(name: str, email: str, password: str, db: Session) -> Us
     
     return new_user
 
+def deactivate_user_account(user_id: int, db: Session):
+    """Deactivate an account - follow with invalidate_principal so open sessions stop working
+
+    The Redis side is left to the caller, so in async IO mode it runs off the event loop.
+    """
+    db.execute(update(User).where(User.id == user_id).values(is_active=False),
+               execution_options={"synchronize_session": False})
+    db.commit()
+
 def authenticate_user_login(email: str, password: str, db: Session) -> User:
     """Authenticate user login - returns user if successful"""
     
@@ -0,0 +1,34 @@
+"""Recompute urls.url_hash in id order - needed after enabling URL_CANONICALIZE, since SQL can't canonicalize"""
+import sys
+import logging
+from sqlalchemy import update, bindparam
+from database import SessionLocal, URL
+from url_service import get_url_fingerprint
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 1000
+
+def backfill_url_hashes(batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    db = SessionLocal()
+    last_id = 0
+    updated = 0
+    try:
+        while True:
+            rows = db.query(URL.id, URL.original_url).filter(URL.id > last_id).order_by(URL.id).limit(batch_size).all()
+            if not rows:
+                return updated
+            db.execute(
+                update(URL.__table__).where(URL.__table__.c.id == bindparam("row_id")).values(url_hash=bindparam("hash")),
+                [{"row_id": row.id, "hash": get_url_fingerprint(row.original_url)} for row in rows]
+            )
+            db.commit()
+            updated += len(rows)
+            last_id = rows[-1].id
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else BACKFILL_BATCH_SIZE
+    logger.info(f"Backfilled url_hash for {backfill_url_hashes(batch_size)} URLs")
@@ -0,0 +1,287 @@
+"""Reproducible load benchmark for the redirect, shorten and dashboard paths
+
+Seeds users, URLs and analytics rows, then drives the app with a weighted, seeded request mix
+and reports throughput and p50/p95/p99 latency per route as JSON.
+
+By default everything runs offline: SQLite for the database, fakeredis for Redis and the app is
+called in-process over ASGI, so two runs with the same arguments are directly comparable.
+Point --database-url / --redis-url at a local MySQL or redis-server, or --base-url at a running
+server, to measure against real backends. In-process with IO_MODE=sync, requests share one event
+loop exactly as they would inside a single uvicorn worker.
+
+Usage (from backend/):
+    python benchmarks/bench_load.py --urls 1000000 --clicks 1000000 --mix redirect --requests 20000
+    python benchmarks/bench_load.py --mix dashboard --output before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+MIXES = {
+    "redirect": {"redirect": 90, "shorten": 5, "list": 5},
+    "shorten": {"shorten": 70, "redirect": 20, "list": 10},
+    "dashboard": {"list": 60, "analytics": 30, "redirect": 10},
+}
+SEED_CHUNK = 10000
+SEED_CODE_LENGTH = 6
+BENCH_PASSWORD = "benchmark"
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "curl/8.4.0",
+    "Googlebot/2.1 (+http://www.google.com/bot.html)",
+]
+REFERERS = [None, "https://www.google.com/", "https://twitter.com/", "https://news.ycombinator.com/", "https://example.org/post"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.gettempdir(), 'bench_load.db')}"))
+    parser.add_argument("--redis-url", default="fake", help="'fake' for an in-process fakeredis, or a redis:// URL")
+    parser.add_argument("--base-url", help="drive an already running server instead of the in-process app")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--urls", type=int, default=1_000_000, help="URLs to seed before measuring")
+    parser.add_argument("--clicks", type=int, default=1_000_000, help="analytics rows to seed before measuring")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="redirect")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=500, help="requests sent before measuring, not reported")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    return parser.parse_args()
+
+def configure_backends(args):
+    """Point the app modules at the chosen stand-ins - must run before anything imports them"""
+    os.environ["DATABASE_URL"] = args.database_url
+    # Every virtual user would otherwise hit its per-user limit within seconds.
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    if args.redis_url == "fake":
+        import redis
+        import redis.asyncio
+        try:
+            import fakeredis
+            import fakeredis.aioredis
+        except ImportError:
+            sys.exit("--redis-url fake needs the fakeredis package (pip install fakeredis)")
+        server = fakeredis.FakeServer()
+        redis.from_url = lambda *args, **kwargs: fakeredis.FakeRedis(server=server)
+        redis.asyncio.from_url = lambda *args, **kwargs: fakeredis.aioredis.FakeRedis(server=server)
+    else:
+        os.environ["REDIS_URL"] = args.redis_url
+
+def seed_code(url_id: int) -> str:
+    # Seeded codes are 6 characters, so they can never clash with the allocator's 7-character ones.
+    from code_service import encode_base62
+    return encode_base62(url_id, SEED_CODE_LENGTH)
+
+def seed(args) -> dict:
+    """Create users, URLs and analytics rows up to the requested counts, reusing earlier seeds"""
+    from sqlalchemy import insert, func
+    from database import Base, engine, SessionLocal, User, URL, Analytics, get_current_time_ist
+    from auth_service import hash_user_password
+    from url_service import get_url_fingerprint
+    from intern_service import user_agent_interner, referer_interner
+
+    Base.metadata.create_all(engine)
+    rng = random.Random(args.seed)
+    now = get_current_time_ist()
+    db = SessionLocal()
+    try:
+        users = db.query(func.count(User.id)).filter(User.email.like("bench%@example.com")).scalar()
+        if users < args.users:
+            password_hash = hash_user_password(BENCH_PASSWORD)
+            db.execute(insert(User), [
+                {"name": f"Bench {index}", "email": f"bench{index}@example.com", "password_hash": password_hash,
+                 "created_at": now, "is_active": True}
+                for index in range(users, args.users)
+            ])
+            db.commit()
+        user_ids = [row.id for row in db.query(User.id).filter(User.email.like("bench%@example.com")).order_by(User.id)]
+
+        # URL n belongs to user_ids[n % users], which is how the load generator picks owned codes.
+        seeded_urls = db.query(func.count(URL.id)).filter(func.length(URL.short_code) == SEED_CODE_LENGTH).scalar()
+        for start in range(seeded_urls, args.urls, SEED_CHUNK):
+            rows = []
+            for url_id in range(start, min(start + SEED_CHUNK, args.urls)):
+                original_url = f"https://example.com/seed/{url_id}"
+                rows.append({
+                    "original_url": original_url, "url_hash": get_url_fingerprint(original_url),
+                    "short_code": seed_code(url_id), "created_at": now - timedelta(seconds=args.urls - url_id),
+                    "is_active": True, "click_count": 0, "user_id": user_ids[url_id % len(user_ids)]
+                })
+            db.execute(insert(URL), rows)
+            db.commit()
+
+        user_agent_ids = user_agent_interner.get_ids(USER_AGENTS, db)
+        referer_ids = referer_interner.get_ids(REFERERS, db)
+        seeded_clicks = db.query(func.count(Analytics.id)).scalar()
+        for start in range(seeded_clicks, args.clicks, SEED_CHUNK):
+            db.execute(insert(Analytics), [
+                {"short_code": seed_code(rng.randrange(args.urls)), "user_agent_id": user_agent_ids[rng.choice(USER_AGENTS)],
+                 "referer_id": referer_ids.get(rng.choice(REFERERS)),
+                 "clicked_at": now - timedelta(seconds=rng.randrange(30 * 86400))}
+                for _ in range(min(SEED_CHUNK, args.clicks - start))
+            ])
+            db.commit()
+        return {"users": len(user_ids), "urls": max(seeded_urls, args.urls), "clicks": max(seeded_clicks, args.clicks)}
+    finally:
+        db.close()
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+
+class VirtualUser:
+    """One logged-in client issuing a seeded random sequence of requests"""
+
+    def __init__(self, client, index: int, args, seeded: dict):
+        self.client = client
+        self.index = index
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.urls = seeded["urls"]
+        self.users = seeded["users"]
+        self.owner_slot = index % self.users
+        self.created = 0
+        routes, weights = zip(*MIXES[args.mix].items())
+        self.routes = routes
+        self.weights = weights
+
+    async def login(self):
+        response = await self.client.post("/api/login", json={"email": f"bench{self.owner_slot}@example.com",
+                                                                "password": BENCH_PASSWORD})
+        response.raise_for_status()
+
+    def owned_code(self) -> str:
+        owned = (self.urls - self.owner_slot + self.users - 1) // self.users
+        return seed_code(self.owner_slot + self.rng.randrange(owned) * self.users)
+
+    async def request(self) -> tuple:
+        route = self.rng.choices(self.routes, self.weights)[0]
+        if route == "redirect":
+            call = self.client.get(f"/{seed_code(self.rng.randrange(self.urls))}", follow_redirects=False)
+        elif route == "shorten":
+            self.created += 1
+            # Timestamped so repeated runs against the same database never hit the dedup path.
+            url = f"https://example.com/bench/{self.index}/{self.created}-{time.time_ns()}"
+            call = self.client.post("/api/shorten", json={"url": url})
+        elif route == "list":
+            call = self.client.get("/api/urls", params={"limit": 50})
+        else:
+            call = self.client.get(f"/api/analytics/{self.owned_code()}")
+        started = time.perf_counter()
+        response = await call
+        return route, (time.perf_counter() - started) * 1000, response.status_code >= 400
+
+async def drive(client_factory, args, seeded: dict) -> dict:
+    clients = [client_factory() for _ in range(args.concurrency)]
+    users = [VirtualUser(client, index, args, seeded) for index, client in enumerate(clients)]
+    try:
+        await asyncio.gather(*(user.login() for user in users))
+
+        async def run(total: int, record: bool):
+            remaining = iter(range(total))
+            latencies = {route: [] for route in MIXES[args.mix]}
+            errors = {route: 0 for route in MIXES[args.mix]}
+
+            async def worker(user):
+                for _ in remaining:
+                    route, latency, failed = await user.request()
+                    latencies[route].append(latency)
+                    errors[route] += failed
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(user) for user in users))
+            elapsed = time.perf_counter() - started
+            if not record:
+                return None
+            all_latencies = [latency for samples in latencies.values() for latency in samples]
+            return {
+                "total": summarize(all_latencies, sum(errors.values()), elapsed),
+                "routes": {route: summarize(samples, errors[route], elapsed)
+                           for route, samples in latencies.items() if samples},
+            }
+
+        await run(args.warmup, record=False)
+        return await run(args.requests, record=True)
+    finally:
+        for client in clients:
+            await client.aclose()
+
+async def run_benchmark(args, seeded: dict) -> dict:
+    import httpx
+    limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+    if args.base_url:
+        return await drive(lambda: httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60), args, seeded)
+
+    from main import app
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        return await drive(lambda: httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60),
+                           args, seeded)
+    finally:
+        await app.router.shutdown()
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    args = parse_args()
+    configure_backends(args)
+    import logging
+    logging.disable(logging.INFO)
+
+    seed_started = time.perf_counter()
+    seeded = seed(args)
+    seed_seconds = time.perf_counter() - seed_started
+
+    results = asyncio.run(run_benchmark(args, seeded))
+    report = {
+        "benchmark": "load",
+        "revision": get_git_revision(),
+        "mix": args.mix,
+        "weights": MIXES[args.mix],
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "target": args.base_url or "in-process",
+        "database": args.database_url.split(":", 1)[0],
+        "redis": "fakeredis" if args.redis_url == "fake" else "redis",
+        "io_mode": os.getenv("IO_MODE", "sync"),
+        "seeded": seeded,
+        "seed_seconds": round(seed_seconds, 1),
+        **results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
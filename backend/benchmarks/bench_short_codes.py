@@ -0,0 +1,85 @@
+"""Compare short code allocation + insert throughput on a large urls table
+
+Usage (from backend/):
+    DATABASE_URL=sqlite:///bench.db python benchmarks/bench_short_codes.py --existing 10000000 --inserts 5000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, func
+from database import Base, engine, SessionLocal, User, URL, get_current_time_ist
+from code_service import (RandomCodeAllocator, BlockCodeAllocator, CodePermutation, generate_random_short_code,
+                          lease_id_block_from_database, lease_id_block_from_redis, SHORT_CODE_SECRET)
+
+SEED_CHUNK = 10000
+
+def seed_urls(existing: int, user_id: int):
+    """Fill the urls table with random 6-character codes until it holds `existing` rows"""
+    db = SessionLocal()
+    try:
+        current = db.query(func.count(URL.id)).scalar()
+        now = get_current_time_ist()
+        while current < existing:
+            chunk = min(SEED_CHUNK, existing - current)
+            codes = {generate_random_short_code() for _ in range(chunk)}
+            taken = {row[0] for row in db.query(URL.short_code).filter(URL.short_code.in_(codes))}
+            db.execute(insert(URL), [
+                {"original_url": f"https://example.com/seed/{code}", "short_code": code,
+                 "created_at": now, "is_active": True, "click_count": 0, "user_id": user_id}
+                for code in codes - taken
+            ])
+            db.commit()
+            current += len(codes - taken)
+        return current
+    finally:
+        db.close()
+
+def run_inserts(allocator, inserts: int, user_id: int, label: str) -> dict:
+    """Allocate a code and insert one row per iteration, committing each like create_short_url"""
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        for index in range(inserts):
+            short_code = allocator.allocate(db)
+            db.add(URL(original_url=f"https://example.com/{label}/{index}", short_code=short_code, user_id=user_id))
+            db.commit()
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+    return {"allocator": label, "inserts": inserts, "seconds": round(elapsed, 3),
+            "inserts_per_second": round(inserts / elapsed, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--existing", type=int, default=10_000_000, help="rows to seed before measuring")
+    parser.add_argument("--inserts", type=int, default=5000, help="rows to insert per allocator")
+    parser.add_argument("--sequence", choices=["database", "redis"], default="database")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    user = db.query(User).filter(User.email == "bench@example.com").first()
+    if not user:
+        user = User(name="Benchmark", email="bench@example.com", password_hash="-")
+        db.add(user)
+        db.commit()
+    user_id = user.id
+    db.close()
+
+    existing = seed_urls(args.existing, user_id)
+
+    lease_block = lease_id_block_from_database if args.sequence == "database" else lease_id_block_from_redis
+    allocators = {
+        "random": RandomCodeAllocator(),
+        "block": BlockCodeAllocator(lease_block, permutation=CodePermutation(SHORT_CODE_SECRET)),
+    }
+    results = [run_inserts(allocator, args.inserts, user_id, label) for label, allocator in allocators.items()]
+    print(json.dumps({"benchmark": "short_codes", "existing_rows": existing, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
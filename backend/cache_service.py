@@ -0,0 +1,493 @@
+import os
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import logging
+import uuid
+from collections import OrderedDict
+import redis
+import redis.asyncio
+from fastapi.concurrency import run_in_threadpool
+from database import URL, get_current_time_ist, run_with_session, ASYNC_IO
+from metrics_service import record_cache_lookup
+from redirect_snapshot_service import redirect_snapshot, to_epoch_seconds, NO_EXPIRY, REDIRECT_SNAPSHOT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+async_redis_client = redis.asyncio.from_url(REDIS_URL) if ASYNC_IO else None
+
+REDIRECT_CACHE_SIZE = int(os.getenv("REDIRECT_CACHE_SIZE", "10000"))
+REDIRECT_CACHE_TTL = float(os.getenv("REDIRECT_CACHE_TTL", "60"))
+REDIRECT_REDIS_TTL = int(os.getenv("REDIRECT_REDIS_TTL", "3600"))
+REDIRECT_NEGATIVE_TTL = int(os.getenv("REDIRECT_NEGATIVE_TTL", "30"))
+REDIRECT_INVALIDATION_CHANNEL = "redirect_cache:invalidate"
+# Recent invalidations by time, so a starting worker can skip codes changed since its snapshot was built.
+REDIRECT_INVALIDATION_LOG_KEY = "redirect_cache:invalidated"
+REDIRECT_INVALIDATION_LOG_SECONDS = REDIRECT_SNAPSHOT_INTERVAL * 2
+URL_LIST_CACHE_TTL = int(os.getenv("URL_LIST_CACHE_TTL", "300"))
+ANALYTICS_CACHE_TTL = int(os.getenv("ANALYTICS_CACHE_TTL", "300"))
+CACHE_VERSION_TTL = 7 * 24 * 3600
+CACHE_FILL_LOCK_MS = int(os.getenv("CACHE_FILL_LOCK_MS", "2000"))
+CACHE_FILL_WAIT_SECONDS = float(os.getenv("CACHE_FILL_WAIT_SECONDS", "1.0"))
+CACHE_FILL_POLL_SECONDS = 0.02
+# XFetch beta: higher values refresh hot keys earlier before they expire, 0 disables early refresh.
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", "1.0"))
+QR_CACHE_MAX_BYTES = int(os.getenv("QR_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+PRINCIPAL_REDIS_TTL = int(os.getenv("PRINCIPAL_REDIS_TTL", "300"))
+PRINCIPAL_INVALIDATION_CHANNEL = "principal_cache:invalidate"
+
+FOUND = "found"
+NOT_FOUND = "not_found"
+EXPIRED = "expired"
+
+# Negative results are stored in Redis under short:{code} as markers that can never be a valid URL.
+_REDIS_MARKERS = {NOT_FOUND: "!404", EXPIRED: "!410"}
+_MARKER_STATUS = {marker: status for status, marker in _REDIS_MARKERS.items()}
+
+class LocalTTLCache:
+    """Bounded, thread-safe LRU cache with a TTL per entry"""
+
+    def __init__(self, max_entries: int, default_ttl: float):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.default_ttl if ttl is None else min(ttl, self.default_ttl)
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class BoundedBytesCache:
+    """Thread-safe LRU cache for byte payloads, bounded by their total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+
+    def get(self, key):
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is not None:
+                self.entries.move_to_end(key)
+            return payload
+
+    def set(self, key, payload: bytes):
+        if len(payload) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= len(previous)
+            self.entries[key] = payload
+            self.total_bytes += len(payload)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+class RedisLock:
+    """Cross-worker lock held under a random token, so only its holder can renew or release it"""
+
+    # KEYS: lock; ARGV: token, TTL in seconds for renew.
+    RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, key: str, ttl: int, client=None):
+        self.key = key
+        self.ttl = ttl
+        self.client = client or redis_client
+        self.token = None
+        self.renew_script = self.client.register_script(self.RENEW_SCRIPT)
+        self.release_script = self.client.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self) -> bool:
+        token = uuid.uuid4().hex
+        if not self.client.set(self.key, token, nx=True, ex=self.ttl):
+            return False
+        self.token = token
+        return True
+
+    def renew(self) -> bool:
+        """Push the lock's expiry out by another TTL - False once it has been lost to expiry"""
+        return bool(self.renew_script(keys=[self.key], args=[self.token, self.ttl]))
+
+    def release(self):
+        self.release_script(keys=[self.key], args=[self.token])
+        self.token = None
+
+redirect_cache = LocalTTLCache(REDIRECT_CACHE_SIZE, REDIRECT_CACHE_TTL)
+qr_image_cache = BoundedBytesCache(QR_CACHE_MAX_BYTES)
+principal_cache = LocalTTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+def get_redirect_ttl(url_record: URL) -> int:
+    """Redis TTL for a redirect target, capped so the key never outlives expires_at"""
+    if not url_record.expires_at:
+        return REDIRECT_REDIS_TTL
+    remaining = (url_record.expires_at - get_current_time_ist()).total_seconds()
+    return int(min(REDIRECT_REDIS_TTL, remaining))
+
+def _load_redirect_from_database(short_code: str, db):
+    url_record = db.query(URL).filter(URL.short_code == short_code).first()
+    # The reaper deactivates expired links without deleting them; anything else inactive is gone.
+    if not url_record or (not url_record.is_active and (url_record.deleted_at or not url_record.expires_at)):
+        return (NOT_FOUND, None), REDIRECT_NEGATIVE_TTL
+
+    ttl = get_redirect_ttl(url_record)
+    if ttl <= 0:
+        return (EXPIRED, None), REDIRECT_REDIS_TTL
+
+    return (FOUND, url_record.original_url), ttl
+
+async def redis_call(command: str, *args, **kwargs):
+    """Run one Redis command on the async client in async IO mode, otherwise on the blocking one"""
+    if async_redis_client is not None:
+        return await getattr(async_redis_client, command)(*args, **kwargs)
+    return getattr(redis_client, command)(*args, **kwargs)
+
+async def redis_pipeline_call(commands: list) -> list:
+    """Run (command, *args) tuples in one round trip"""
+    if async_redis_client is not None:
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            for command, *args in commands:
+                getattr(pipe, command)(*args)
+            return await pipe.execute()
+
+    pipe = redis_client.pipeline(transaction=False)
+    for command, *args in commands:
+        getattr(pipe, command)(*args)
+    return pipe.execute()
+
+async def run_blocking(function, *args, **kwargs):
+    """Keep blocking helpers off the event loop in async IO mode"""
+    if ASYNC_IO:
+        return await run_in_threadpool(function, *args, **kwargs)
+    return function(*args, **kwargs)
+
+# Per-worker single-flight state: one loading task per cache key, and a moving average of load time per namespace.
+_fill_tasks = {}
+_load_seconds = {}
+
+def get_payload_etag(payload: bytes) -> str:
+    """Strong ETag for a serialized response body"""
+    return '"' + hashlib.blake2b(payload, digest_size=16).hexdigest() + '"'
+
+async def get_cached_etag(cache_key: str):
+    """ETag of the payload currently cached under a key filled with_etag, without reading the payload"""
+    etag = await redis_call("get", f"etag:{cache_key}")
+    return etag.decode('utf-8') if etag else None
+
+def _cached_value(value: bytes, raw: bool):
+    return value if raw else value.decode('utf-8')
+
+def _remaining_seconds(remaining_ms):
+    return remaining_ms / 1000 if remaining_ms is not None and remaining_ms > 0 else None
+
+def _should_refresh_early(namespace: str, remaining_ms) -> bool:
+    """Probabilistic early expiration (XFetch): the closer a key is to expiry, the likelier a refresh"""
+    if CACHE_EARLY_REFRESH_BETA <= 0 or remaining_ms is None or remaining_ms < 0:
+        return False
+    load_seconds = _load_seconds.get(namespace, 0.01)
+    return load_seconds * CACHE_EARLY_REFRESH_BETA * -math.log(1.0 - random.random()) * 1000 >= remaining_ms
+
+async def _wait_for_fill(cache_key: str, raw: bool):
+    """Poll for a value another worker is loading under the fill lock"""
+    deadline = time.monotonic() + CACHE_FILL_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(CACHE_FILL_POLL_SECONDS)
+        value, remaining_ms = await redis_pipeline_call([("get", cache_key), ("pttl", cache_key)])
+        if value is not None:
+            return _cached_value(value, raw), _remaining_seconds(remaining_ms)
+    return None
+
+async def _fill(cache_key: str, namespace: str, load, stale, raw: bool, with_etag: bool):
+    """Load a value under a short cross-worker lock; losers wait for the winner or keep serving stale"""
+    lock_key = f"fill_lock:{cache_key}"
+    try:
+        locked = await redis_call("set", lock_key, 1, nx=True, px=CACHE_FILL_LOCK_MS)
+    except Exception as redis_error:
+        logger.warning(f"Cache fill lock failed for {cache_key}: {redis_error}")
+        locked = None
+
+    if not locked:
+        if stale is not None:
+            return stale
+        try:
+            filled = await _wait_for_fill(cache_key, raw)
+        except Exception:
+            filled = None
+        if filled is not None:
+            return filled
+
+    started = time.perf_counter()
+    try:
+        value, ttl = await load()
+        elapsed = time.perf_counter() - started
+        _load_seconds[namespace] = 0.8 * _load_seconds.get(namespace, elapsed) + 0.2 * elapsed
+        if ttl > 0:
+            commands = [("setex", cache_key, ttl, value)]
+            if with_etag:
+                commands.append(("setex", f"etag:{cache_key}", ttl, get_payload_etag(value)))
+            try:
+                await redis_pipeline_call(commands)
+            except Exception as redis_error:
+                logger.warning(f"Failed to cache {cache_key}: {redis_error}")
+        return value, ttl
+    finally:
+        if locked:
+            try:
+                await redis_call("delete", lock_key)
+            except Exception:
+                pass
+
+async def load_through_cache(cache_key: str, load, namespace: str = None, raw: bool = False,
+                             with_etag: bool = False):
+    """Read a Redis cache key, filling misses through one load per key per worker
+
+    `load` is an async callable returning (value, ttl_seconds). Concurrent misses in this worker
+    share one load, other workers wait briefly on a Redis fill lock, and hot keys are refreshed
+    just before they expire. Returns (value, remaining_ttl_seconds), with the value as cached
+    bytes if `raw`. `with_etag` also stores the value's ETag under etag:{cache_key}.
+    """
+    namespace = namespace or cache_key.split(":", 1)[0]
+    try:
+        cached_value, remaining_ms = await redis_pipeline_call([("get", cache_key), ("pttl", cache_key)])
+    except Exception as redis_error:
+        logger.warning(f"Redis lookup failed for {cache_key}: {redis_error}")
+        cached_value, remaining_ms = None, None
+
+    stale = None
+    if cached_value is not None:
+        stale = (_cached_value(cached_value, raw), _remaining_seconds(remaining_ms))
+        if not _should_refresh_early(namespace, remaining_ms):
+            record_cache_lookup(namespace, True)
+            return stale
+    record_cache_lookup(namespace, False)
+
+    task = _fill_tasks.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_fill(cache_key, namespace, load, stale, raw, with_etag))
+        _fill_tasks[cache_key] = task
+        task.add_done_callback(lambda _: _fill_tasks.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+async def resolve_short_code(short_code: str, db):
+    """Look up a short code through the snapshot, local cache, Redis and MySQL - returns (status, original_url)"""
+    snapshot_entry = redirect_snapshot.lookup(short_code)
+    if redirect_snapshot.enabled:
+        record_cache_lookup("redirect_snapshot", snapshot_entry is not None)
+    if snapshot_entry is not None:
+        original_url, expires_at = snapshot_entry
+        if expires_at != NO_EXPIRY and expires_at <= to_epoch_seconds(get_current_time_ist()):
+            return EXPIRED, None
+        return FOUND, original_url
+
+    entry = redirect_cache.get(short_code)
+    record_cache_lookup("redirect_local", entry is not None)
+    if entry is not None:
+        return entry
+
+    async def load():
+        (status, original_url), ttl = await run_with_session(db, _load_redirect_from_database, short_code)
+        return (original_url if status == FOUND else _REDIS_MARKERS[status]), ttl
+
+    value, ttl = await load_through_cache(f"short:{short_code}", load)
+    status = _MARKER_STATUS.get(value)
+    entry = (status, None) if status else (FOUND, value)
+    redirect_cache.set(short_code, entry, ttl)
+    return entry
+
+def cache_redirect_target(url_record: URL):
+    """Prime Redis with a new redirect target and clear any stale negative entries"""
+    ttl = get_redirect_ttl(url_record)
+    if ttl > 0:
+        redis_client.setex(f"short:{url_record.short_code}", ttl, url_record.original_url)
+    publish_redirect_invalidation(url_record.short_code)
+
+def invalidate_redirect(short_code: str):
+    """Drop a short code from Redis and from every worker's local cache"""
+    invalidate_redirects([short_code])
+
+def invalidate_redirects(short_codes: list):
+    """invalidate_redirect for many codes at once, such as a batch of new links"""
+    if not short_codes:
+        return
+    redis_client.delete(*[f"short:{short_code}" for short_code in short_codes])
+    publish_redirect_invalidations(short_codes)
+
+def publish_redirect_invalidation(short_code: str):
+    publish_redirect_invalidations([short_code])
+
+def publish_redirect_invalidations(short_codes: list):
+    for short_code in short_codes:
+        redirect_cache.delete(short_code)
+        redirect_snapshot.invalidate(short_code)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for short_code in short_codes:
+            pipe.publish(REDIRECT_INVALIDATION_CHANNEL, short_code)
+        if redirect_snapshot.enabled:
+            now = time.time()
+            pipe.zadd(REDIRECT_INVALIDATION_LOG_KEY, {short_code: now for short_code in short_codes})
+            pipe.zremrangebyscore(REDIRECT_INVALIDATION_LOG_KEY, "-inf", now - REDIRECT_INVALIDATION_LOG_SECONDS)
+        pipe.execute()
+    except Exception as redis_error:
+        logger.warning(f"Failed to publish cache invalidation for {', '.join(short_codes)}: {redis_error}")
+
+def load_recent_redirect_invalidations() -> dict:
+    """short_code -> time of its latest invalidation, for the last REDIRECT_INVALIDATION_LOG_SECONDS"""
+    if not redirect_snapshot.enabled:
+        return {}
+    entries = redis_client.zrangebyscore(REDIRECT_INVALIDATION_LOG_KEY, time.time() - REDIRECT_INVALIDATION_LOG_SECONDS,
+                                         "+inf", withscores=True)
+    return {short_code.decode('utf-8'): invalidated_at for short_code, invalidated_at in entries}
+
+async def get_cache_version(namespace: str, ident) -> int:
+    """Current generation of a cache namespace, embedded in the cache keys it owns"""
+    version = await redis_call("get", f"cache_version:{namespace}:{ident}")
+    return int(version) if version else 0
+
+def bump_cache_versions(namespace: str, idents):
+    """Invalidate cached entries for each ident by moving it to a new generation"""
+    pipe = redis_client.pipeline(transaction=False)
+    for ident in set(idents):
+        version_key = f"cache_version:{namespace}:{ident}"
+        pipe.incr(version_key)
+        pipe.expire(version_key, CACHE_VERSION_TTL)
+    pipe.execute()
+
+async def get_url_list_cache_key(user_id: int, *page_params) -> str:
+    version = await get_cache_version("urls_list", user_id)
+    return f"urls_list:{user_id}:v{version}:" + ":".join(str(param) for param in page_params)
+
+async def get_analytics_cache_key(short_code: str, user_id: int) -> str:
+    # Scoped to the owner too, so finding an ETag under this key proves the caller may see it.
+    version = await get_cache_version("analytics", short_code)
+    return f"analytics:{user_id}:{short_code}:v{version}"
+
+def invalidate_user_caches(user_ids=(), short_codes=()):
+    """Bump list generations for the given users and analytics generations for the given codes"""
+    try:
+        if user_ids:
+            bump_cache_versions("urls_list", user_ids)
+        if short_codes:
+            bump_cache_versions("analytics", short_codes)
+    except Exception as cache_error:
+        logger.warning(f"Cache invalidation failed: {cache_error}")
+
+def invalidate_principal(user_id: int):
+    """Drop a user's cached session principal from Redis and from every worker's local cache"""
+    principal_cache.delete(user_id)
+    try:
+        redis_client.delete(f"principal:{user_id}")
+        redis_client.publish(PRINCIPAL_INVALIDATION_CHANNEL, str(user_id))
+    except Exception as redis_error:
+        logger.warning(f"Failed to invalidate principal {user_id}: {redis_error}")
+
+class RedirectInvalidationListener:
+    """Background subscriber that evicts local cache entries invalidated by other workers"""
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="redirect-invalidation", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker = None
+
+    def _run(self):
+        subscribed_before = False
+        while not self.stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REDIRECT_INVALIDATION_CHANNEL, PRINCIPAL_INVALIDATION_CHANNEL)
+                if subscribed_before:
+                    # Anything published while we were disconnected was missed, so start from a clean slate.
+                    redirect_cache.clear()
+                    principal_cache.clear()
+                    redirect_snapshot.invalidate_all()
+                else:
+                    # Nothing is cached yet; only the shared snapshot may predate recent changes, and those
+                    # are in the log - so a worker starting up never forces a rebuild.
+                    redirect_snapshot.invalidate_many(load_recent_redirect_invalidations())
+                    subscribed_before = True
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message["type"] != "message":
+                        continue
+                    if message["channel"].decode('utf-8') == PRINCIPAL_INVALIDATION_CHANNEL:
+                        principal_cache.delete(int(message["data"]))
+                    else:
+                        short_code = message["data"].decode('utf-8')
+                        redirect_cache.delete(short_code)
+                        redirect_snapshot.invalidate(short_code)
+            except Exception as e:
+                logger.warning(f"Redirect invalidation listener error: {e}")
+                self.stopped.wait(1.0)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+redirect_invalidation_listener = RedirectInvalidationListener()
@@ -0,0 +1,184 @@
+import os
+import queue
+import threading
+import time
+import uuid
+import logging
+from collections import Counter
+from sqlalchemy import insert, select
+from database import SessionLocal, URL, Analytics, get_current_time_ist, run_with_session
+from url_service import record_url_click
+from cache_service import invalidate_user_caches, run_blocking
+from counter_service import redis_counters_enabled, increment_click_counts, apply_click_counts, commit_click_counts
+from intern_service import user_agent_interner, referer_interner
+
+logger = logging.getLogger(__name__)
+
+CLICK_INGESTION_MODE = os.getenv("CLICK_INGESTION_MODE", "async")
+CLICK_QUEUE_SIZE = int(os.getenv("CLICK_QUEUE_SIZE", "10000"))
+CLICK_BATCH_SIZE = int(os.getenv("CLICK_BATCH_SIZE", "500"))
+CLICK_FLUSH_INTERVAL = float(os.getenv("CLICK_FLUSH_INTERVAL", "1.0"))
+CLICK_DRAIN_TIMEOUT = float(os.getenv("CLICK_DRAIN_TIMEOUT", "10.0"))
+
+_STOP = object()
+
+class ClickIngestionQueue:
+    """Bounded in-process queue with a background writer that bulk-inserts clicks"""
+
+    def __init__(self, max_size=CLICK_QUEUE_SIZE, batch_size=CLICK_BATCH_SIZE,
+                 flush_interval=CLICK_FLUSH_INTERVAL):
+        self.events = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.worker = None
+        self.stats = Counter()
+
+    def start(self):
+        """Start the background writer thread"""
+        if self.worker and self.worker.is_alive():
+            return
+        self.worker = threading.Thread(target=self._run, name="click-ingestion", daemon=True)
+        self.worker.start()
+        logger.info("Click ingestion worker started")
+
+    def stop(self, timeout=CLICK_DRAIN_TIMEOUT):
+        """Flush everything still queued and stop the writer thread"""
+        if not self.worker:
+            return
+        self.events.put(_STOP)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logger.warning(f"Click ingestion did not drain within {timeout}s, {self.events.qsize()} events left")
+        self.worker = None
+
+    def submit(self, short_code: str, user_agent: str, referer: str) -> bool:
+        """Queue a click without blocking - returns False if the event was dropped"""
+        try:
+            self.events.put_nowait((short_code, user_agent, referer, get_current_time_ist()))
+            self.stats["enqueued"] += 1
+            return True
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+
+    def get_stats(self) -> dict:
+        """Counters for monitoring queue health"""
+        return {
+            "queued": self.events.qsize(),
+            "capacity": self.events.maxsize,
+            "enqueued": self.stats["enqueued"],
+            "dropped": self.stats["dropped"],
+            "written": self.stats["written"],
+            "batches": self.stats["batches"],
+            "failed": self.stats["failed"],
+        }
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        stopping = False
+
+        while not stopping:
+            timeout = max(deadline - time.monotonic(), 0)
+            try:
+                event = self.events.get(timeout=timeout)
+                if event is _STOP:
+                    stopping = True
+                else:
+                    batch.append(event)
+            except queue.Empty:
+                pass
+
+            if stopping or len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if stopping:
+                    batch.extend(self._drain_remaining())
+                for start in range(0, len(batch), self.batch_size):
+                    self._flush(batch[start:start + self.batch_size])
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _drain_remaining(self):
+        remaining = []
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return remaining
+            if event is not _STOP:
+                remaining.append(event)
+
+    def _flush(self, batch):
+        if not batch:
+            return
+
+        click_totals = Counter(event[0] for event in batch)
+        db = SessionLocal()
+        try:
+            user_agent_ids = user_agent_interner.get_ids([event[1] for event in batch], db)
+            referer_ids = referer_interner.get_ids([event[2] for event in batch], db)
+            db.execute(insert(Analytics), [
+                {
+                    "short_code": short_code,
+                    "user_agent_id": user_agent_ids.get(user_agent),
+                    "referer_id": referer_ids.get(referer),
+                    "clicked_at": clicked_at
+                }
+                for short_code, user_agent, referer, clicked_at in batch
+            ])
+            if not redis_counters_enabled():
+                apply_click_counts(click_totals, db)
+            owner_ids = db.execute(
+                select(URL.user_id).where(URL.short_code.in_(list(click_totals))).distinct()
+            ).scalars().all()
+            db.commit()
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            db.rollback()
+            self.stats["failed"] += len(batch)
+            logger.error(f"Failed to write batch of {len(batch)} clicks: {e}")
+            return
+        finally:
+            db.close()
+
+        # Counted in Redis only after the commit, so a failed batch never inflates the displayed counts.
+        if redis_counters_enabled() and not increment_click_counts(click_totals, uuid.uuid4().hex):
+            self._count_in_database(click_totals)
+        invalidate_user_caches(user_ids=owner_ids, short_codes=click_totals)
+
+    def _count_in_database(self, click_totals: dict):
+        db = SessionLocal()
+        try:
+            commit_click_counts(click_totals, db)
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Failed to count {sum(click_totals.values())} committed clicks: {e}")
+        finally:
+            db.close()
+
+click_queue = ClickIngestionQueue()
+
+def start_click_ingestion():
+    """Start the background writer when async ingestion is enabled"""
+    if CLICK_INGESTION_MODE == "async":
+        click_queue.start()
+
+def stop_click_ingestion():
+    """Drain pending clicks on shutdown"""
+    if CLICK_INGESTION_MODE == "async":
+        click_queue.stop()
+
+async def track_url_click(short_code: str, user_agent: str, referer: str, db=None):
+    """Record a click either inline or through the write-behind queue"""
+    if CLICK_INGESTION_MODE == "async":
+        click_queue.submit(short_code, user_agent, referer)
+        return
+    # Redis calls stay outside run_with_session: in async IO mode it runs on the event loop.
+    counted_in_redis = redis_counters_enabled()
+    owner_id = await run_with_session(db, record_url_click, short_code, user_agent, referer, counted_in_redis)
+    if owner_id is None:
+        return
+    # The counter moves only once the click is committed; without Redis it goes to the database instead.
+    if counted_in_redis and not await run_blocking(increment_click_counts, {short_code: 1}):
+        await run_with_session(db, commit_click_counts, {short_code: 1})
+    await run_blocking(invalidate_user_caches, user_ids=[owner_id], short_codes=[short_code])
@@ -0,0 +1,252 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+import redis
+from database import SessionLocal, URL, get_current_time_ist
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+
+SHORT_CODE_FILTER_ENABLED = os.getenv("SHORT_CODE_FILTER_ENABLED", "true").lower() == "true"
+SHORT_CODE_FILTER_FPR = float(os.getenv("SHORT_CODE_FILTER_FPR", "0.001"))
+SHORT_CODE_FILTER_HEADROOM = float(os.getenv("SHORT_CODE_FILTER_HEADROOM", "1.5"))
+SHORT_CODE_FILTER_MIN_CAPACITY = int(os.getenv("SHORT_CODE_FILTER_MIN_CAPACITY", "100000"))
+SHORT_CODE_FILTER_REBUILD_INTERVAL = int(os.getenv("SHORT_CODE_FILTER_REBUILD_INTERVAL", "3600"))
+SHORT_CODE_FILTER_CHECK_INTERVAL = float(os.getenv("SHORT_CODE_FILTER_CHECK_INTERVAL", "30"))
+# Codes created this long before a snapshot was taken are re-read, covering transactions still open at the time.
+SHORT_CODE_FILTER_CATCHUP_SECONDS = int(os.getenv("SHORT_CODE_FILTER_CATCHUP_SECONDS", "120"))
+SCAN_FETCH_SIZE = 10000
+
+SNAPSHOT_KEY = "short_code_filter:snapshot"
+GENERATION_KEY = "short_code_filter:generation"
+REBUILD_LOCK_KEY = "short_code_filter:rebuild_lock"
+ADD_CHANNEL = "short_code_filter:add"
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, using double hashing of one BLAKE2b digest"""
+
+    def __init__(self, bit_count: int, hash_count: int, data: bytearray = None, count: int = 0):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = data if data is not None else bytearray((bit_count + 7) // 8)
+        self.count = count
+        # Request threads and the pub/sub listener both add; an unguarded `|=` can drop another thread's bit.
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_capacity(cls, capacity: int, false_positive_rate: float) -> "BloomFilter":
+        capacity = max(capacity, 1)
+        bit_count = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        return cls(bit_count, hash_count)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * second) % self.bit_count for index in range(self.hash_count)]
+
+    def add(self, key: str):
+        # Only count keys that set a new bit, so adding the same code twice doesn't inflate the count.
+        positions = self._positions(key)
+        added = False
+        with self.lock:
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not self.bits[position >> 3] & mask:
+                    self.bits[position >> 3] |= mask
+                    added = True
+            self.count += added
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.bits)
+
+    @property
+    def capacity(self) -> int:
+        return int(self.bit_count * math.log(2) / self.hash_count)
+
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.bit_count)) ** self.hash_count
+
+    def to_snapshot(self, built_at) -> bytes:
+        header = {"bit_count": self.bit_count, "hash_count": self.hash_count, "count": self.count,
+                  "built_at": built_at.isoformat()}
+        return json.dumps(header).encode() + b"\n" + bytes(self.bits)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: bytes) -> tuple:
+        header, data = snapshot.split(b"\n", 1)
+        header = json.loads(header)
+        bloom = cls(header["bit_count"], header["hash_count"], bytearray(data), header["count"])
+        return bloom, datetime.fromisoformat(header["built_at"])
+
+def build_filter_from_database() -> tuple:
+    """Scan every code that still resolves (active or expired, not deleted) into a filter sized for them - returns (filter, built_at)"""
+    built_at = get_current_time_ist()
+    db = SessionLocal()
+    try:
+        active = db.query(URL.id).filter(URL.deleted_at == None).count()
+        bloom = BloomFilter.for_capacity(
+            max(SHORT_CODE_FILTER_MIN_CAPACITY, int(active * SHORT_CODE_FILTER_HEADROOM)), SHORT_CODE_FILTER_FPR
+        )
+        result = db.execute(
+            URL.__table__.select().with_only_columns(URL.short_code).where(URL.deleted_at == None),
+            execution_options={"stream_results": True, "yield_per": SCAN_FETCH_SIZE}
+        )
+        for rows in result.partitions():
+            for row in rows:
+                bloom.add(row.short_code)
+        return bloom, built_at
+    finally:
+        db.close()
+
+def load_codes_created_since(since) -> list:
+    db = SessionLocal()
+    try:
+        return [row.short_code for row in db.query(URL.short_code).filter(
+            URL.deleted_at == None,
+            URL.created_at >= since
+        )]
+    finally:
+        db.close()
+
+class ShortCodeFilter:
+    """Per-worker Bloom filter of active short codes, so unknown codes 404 without touching Redis or MySQL
+
+    The filter is built from the database (or a snapshot another worker saved in Redis) by a
+    background thread, receives new codes over pub/sub and is rebuilt every
+    SHORT_CODE_FILTER_REBUILD_INTERVAL seconds to shed deleted codes. Until it is ready, or while
+    the pub/sub connection is down, every code is let through.
+    """
+
+    def __init__(self, enabled: bool = SHORT_CODE_FILTER_ENABLED):
+        self.enabled = enabled
+        self.bloom = None
+        self.ready = False
+        self.generation = None
+        self.stopped = threading.Event()
+        self.worker = None
+        self.stats = Counter()
+
+    def start(self):
+        if not self.enabled or (self.worker and self.worker.is_alive()):
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="short-code-filter", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker = None
+
+    def might_contain(self, short_code: str) -> bool:
+        """False only when the code is definitely not an active short code"""
+        bloom = self.bloom
+        if not self.ready or bloom is None:
+            return True
+        if short_code in bloom:
+            self.stats["passed"] += 1
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def add(self, short_codes: list):
+        """Record newly created codes here and in every other worker's filter"""
+        if not self.enabled or not short_codes:
+            return
+        bloom = self.bloom
+        if bloom is not None:
+            for short_code in short_codes:
+                bloom.add(short_code)
+        try:
+            redis_client.publish(ADD_CHANNEL, json.dumps(list(short_codes)))
+        except Exception as redis_error:
+            logger.warning(f"Failed to publish new short codes to the filter: {redis_error}")
+
+    def get_stats(self) -> dict:
+        bloom = self.bloom
+        return {
+            "ready": self.ready,
+            "items": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "bit_count": bloom.bit_count if bloom else 0,
+            "hash_count": bloom.hash_count if bloom else 0,
+            "memory_bytes": bloom.memory_bytes if bloom else 0,
+            "estimated_false_positive_rate": round(bloom.estimated_false_positive_rate(), 6) if bloom else None,
+            "passed": self.stats["passed"],
+            "rejected": self.stats["rejected"],
+            "rebuilds": self.stats["rebuilds"],
+        }
+
+    def _run(self):
+        while not self.stopped.is_set():
+            pubsub = None
+            try:
+                # Subscribe before loading, so codes created during the load still arrive afterwards.
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(ADD_CHANNEL)
+                self._refresh()
+                next_check = time.monotonic() + SHORT_CODE_FILTER_CHECK_INTERVAL
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message and message["type"] == "message":
+                        for short_code in json.loads(message["data"]):
+                            self.bloom.add(short_code)
+                    if time.monotonic() >= next_check:
+                        self._refresh()
+                        next_check = time.monotonic() + SHORT_CODE_FILTER_CHECK_INTERVAL
+            except Exception as e:
+                # Additions may have been missed, so stop trusting the filter until it is reloaded.
+                self.ready = False
+                logger.warning(f"Short code filter error: {e}")
+                self.stopped.wait(1.0)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _refresh(self):
+        """Rebuild for everyone if this worker wins the interval lock, otherwise adopt the newest shared snapshot"""
+        if self.bloom is not None and self.bloom.count > self.bloom.capacity:
+            # Past capacity the false-positive rate climbs, so don't wait out the interval.
+            redis_client.delete(REBUILD_LOCK_KEY)
+
+        if redis_client.set(REBUILD_LOCK_KEY, 1, nx=True, ex=SHORT_CODE_FILTER_REBUILD_INTERVAL):
+            bloom, built_at = build_filter_from_database()
+            pipe = redis_client.pipeline()
+            pipe.set(SNAPSHOT_KEY, bloom.to_snapshot(built_at))
+            pipe.incr(GENERATION_KEY)
+            generation = pipe.execute()[1]
+            self.stats["rebuilds"] += 1
+            logger.info(f"Rebuilt short code filter: {bloom.count} codes in {bloom.memory_bytes} bytes")
+        else:
+            generation = int(redis_client.get(GENERATION_KEY) or 0)
+            if self.ready and generation == self.generation:
+                return
+            snapshot = redis_client.get(SNAPSHOT_KEY)
+            if snapshot:
+                bloom, built_at = BloomFilter.from_snapshot(snapshot)
+                catch_up_since = built_at - timedelta(seconds=SHORT_CODE_FILTER_CATCHUP_SECONDS)
+                for short_code in load_codes_created_since(catch_up_since):
+                    bloom.add(short_code)
+            else:
+                bloom, _ = build_filter_from_database()
+
+        self.bloom = bloom
+        self.generation = generation
+        self.ready = True
+
+short_code_filter = ShortCodeFilter()
@@ -0,0 +1,234 @@
+import os
+import string
+import random
+import hashlib
+import threading
+import logging
+from collections import deque
+import redis
+from database import SessionLocal, URL, CodeSequence
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+
+SHORT_CODE_ALLOCATOR = os.getenv("SHORT_CODE_ALLOCATOR", "block")
+SHORT_CODE_SEQUENCE = os.getenv("SHORT_CODE_SEQUENCE", "redis")
+SHORT_CODE_BLOCK_SIZE = int(os.getenv("SHORT_CODE_BLOCK_SIZE", "1000"))
+SHORT_CODE_LENGTH = int(os.getenv("SHORT_CODE_LENGTH", "7"))
+SHORT_CODE_SCRAMBLE = os.getenv("SHORT_CODE_SCRAMBLE", "true").lower() == "true"
+SHORT_CODE_SECRET = os.getenv("SHORT_CODE_SECRET", "change-this-in-production-please")
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+SEQUENCE_NAME = "short_code"
+REDIS_SEQUENCE_KEY = "short_code:sequence"
+
+def generate_random_short_code(length=6):
+    """Generate a random short code for URLs"""
+    characters = string.ascii_letters + string.digits
+    return ''.join(random.choice(characters) for _ in range(length))
+
+def encode_base62(number: int, length: int = SHORT_CODE_LENGTH) -> str:
+    """Encode a non-negative integer as a fixed-width base62 string"""
+    digits = []
+    while number:
+        number, remainder = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[remainder])
+    return ''.join(reversed(digits)).rjust(length, BASE62_ALPHABET[0])
+
+def decode_base62(code: str) -> int:
+    number = 0
+    for char in code:
+        number = number * 62 + BASE62_ALPHABET.index(char)
+    return number
+
+class CodePermutation:
+    """Keyed, reversible permutation of [0, 62^length) so sequential ids don't give sequential codes
+
+    A 4-round Feistel network over the smallest even bit width covering the domain,
+    with cycle walking to stay inside it.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, secret: str, length: int = SHORT_CODE_LENGTH):
+        self.domain = 62 ** length
+        self.half_bits = ((self.domain - 1).bit_length() + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.key = hashlib.sha256(secret.encode()).digest()
+
+    def _round(self, round_number: int, value: int) -> int:
+        digest = hashlib.blake2b(f"{round_number}:{value}".encode(), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") & self.half_mask
+
+    def _encrypt_once(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_number in range(self.ROUNDS):
+            left, right = right, left ^ self._round(round_number, right)
+        return (left << self.half_bits) | right
+
+    def _decrypt_once(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_number in reversed(range(self.ROUNDS)):
+            left, right = right ^ self._round(round_number, left), left
+        return (left << self.half_bits) | right
+
+    def permute(self, value: int) -> int:
+        value = self._encrypt_once(value)
+        while value >= self.domain:
+            value = self._encrypt_once(value)
+        return value
+
+    def invert(self, value: int) -> int:
+        value = self._decrypt_once(value)
+        while value >= self.domain:
+            value = self._decrypt_once(value)
+        return value
+
+# INCRBY that only runs on an existing counter unless a seed (ARGV[2]) is given, so a Redis that lost
+# the counter is reseeded from code_sequences instead of starting over at 0.
+LEASE_SEEDED_BLOCK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[2] == '' then
+        return false
+    end
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
+lease_seeded_block_script = redis_client.register_script(LEASE_SEEDED_BLOCK_SCRIPT)
+
+def get_database_sequence_value() -> int:
+    db = SessionLocal()
+    try:
+        sequence = db.query(CodeSequence).filter(CodeSequence.name == SEQUENCE_NAME).first()
+        return sequence.next_value if sequence else 0
+    finally:
+        db.close()
+
+def raise_database_sequence_value(value: int):
+    """Move code_sequences up to value, so it never trails ids the Redis counter handed out"""
+    db = SessionLocal()
+    try:
+        sequence = db.query(CodeSequence).filter(CodeSequence.name == SEQUENCE_NAME).with_for_update().first()
+        if not sequence:
+            db.add(CodeSequence(name=SEQUENCE_NAME, next_value=value))
+        elif sequence.next_value < value:
+            sequence.next_value = value
+        db.commit()
+    finally:
+        db.close()
+
+def lease_id_block_from_redis(block_size: int) -> int:
+    """Reserve block_size ids with one INCRBY - returns the first id of the block
+
+    The end of every block is recorded in code_sequences before it is used, and a missing counter
+    is seeded from there, so a Redis restart or failover never reissues ids.
+    """
+    block_end = lease_seeded_block_script(keys=[REDIS_SEQUENCE_KEY], args=[block_size, ""])
+    if block_end is None:
+        block_end = lease_seeded_block_script(keys=[REDIS_SEQUENCE_KEY],
+                                              args=[block_size, get_database_sequence_value()])
+    raise_database_sequence_value(block_end)
+    return block_end - block_size
+
+def lease_id_block_from_database(block_size: int) -> int:
+    """Reserve block_size ids from the code_sequences table - returns the first id of the block"""
+    db = SessionLocal()
+    try:
+        sequence = db.query(CodeSequence).filter(CodeSequence.name == SEQUENCE_NAME).with_for_update().first()
+        if not sequence:
+            sequence = CodeSequence(name=SEQUENCE_NAME, next_value=0)
+            db.add(sequence)
+        start = sequence.next_value
+        sequence.next_value = start + block_size
+        db.commit()
+        return start
+    finally:
+        db.close()
+
+class RandomCodeAllocator:
+    """Original allocator: random codes checked against the database until one is free"""
+
+    def allocate(self, db) -> str:
+        short_code = generate_random_short_code()
+        while db.query(URL).filter(URL.short_code == short_code, URL.is_active == True).first():
+            short_code = generate_random_short_code()
+        return short_code
+
+    def allocate_many(self, count: int, db) -> list:
+        return [self.allocate(db) for _ in range(count)]
+
+    def reserve(self, count: int):
+        """Nothing to lease ahead: every check runs on the caller's session"""
+
+class BlockCodeAllocator:
+    """Hands out codes from leased id blocks, so the common case needs no round trip"""
+
+    def __init__(self, lease_block, block_size: int = SHORT_CODE_BLOCK_SIZE, length: int = SHORT_CODE_LENGTH,
+                 permutation: CodePermutation = None):
+        self.lease_block = lease_block
+        self.block_size = block_size
+        self.length = length
+        self.permutation = permutation
+        self.lock = threading.Lock()
+        # [next id, end] of each leased block not yet used up, oldest first.
+        self.blocks = deque()
+
+    def reserve(self, count: int):
+        """Lease ahead so at least count ids are on hand
+
+        In async IO mode allocation runs inside run_sync on the event loop, so request handlers call
+        this from the threadpool first and the lease's Redis or MySQL round trip never blocks the loop.
+        """
+        with self.lock:
+            missing = count - sum(end - next_id for next_id, end in self.blocks)
+        if missing > 0:
+            self._lease(missing)
+
+    def _lease(self, count: int):
+        # Leased outside the lock, so a slow lease never stalls callers that still have ids;
+        # two concurrent leases just queue two blocks.
+        lease_size = max(self.block_size, count)
+        start = self.lease_block(lease_size)
+        with self.lock:
+            self.blocks.append([start, start + lease_size])
+
+    def _next_ids(self, count: int) -> list:
+        ids = []
+        while True:
+            with self.lock:
+                while self.blocks and len(ids) < count:
+                    block = self.blocks[0]
+                    take = min(count - len(ids), block[1] - block[0])
+                    ids.extend(range(block[0], block[0] + take))
+                    block[0] += take
+                    if block[0] == block[1]:
+                        self.blocks.popleft()
+                if len(ids) == count:
+                    return ids
+            self._lease(count - len(ids))
+
+    def _encode(self, sequence_id: int) -> str:
+        if self.permutation:
+            sequence_id = self.permutation.permute(sequence_id)
+        return encode_base62(sequence_id, self.length)
+
+    def allocate(self, db=None) -> str:
+        return self._encode(self._next_ids(1)[0])
+
+    def allocate_many(self, count: int, db=None) -> list:
+        return [self._encode(sequence_id) for sequence_id in self._next_ids(count)]
+
+def create_code_allocator():
+    """Build the allocator selected by SHORT_CODE_ALLOCATOR"""
+    if SHORT_CODE_ALLOCATOR == "random":
+        return RandomCodeAllocator()
+
+    lease_block = lease_id_block_from_database if SHORT_CODE_SEQUENCE == "database" else lease_id_block_from_redis
+    permutation = CodePermutation(SHORT_CODE_SECRET, SHORT_CODE_LENGTH) if SHORT_CODE_SCRAMBLE else None
+    return BlockCodeAllocator(lease_block, permutation=permutation)
+
+code_allocator = create_code_allocator()
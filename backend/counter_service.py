@@ -0,0 +1,279 @@
+import os
+import uuid
+import random
+import threading
+import logging
+import redis
+from sqlalchemy import select, update, case
+from database import SessionLocal, URL, ClickFlush
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+
+CLICK_COUNTER_MODE = os.getenv("CLICK_COUNTER_MODE", "redis")
+CLICK_COUNTER_SHARDS = int(os.getenv("CLICK_COUNTER_SHARDS", "8"))
+CLICK_COUNTER_FLUSH_INTERVAL = float(os.getenv("CLICK_COUNTER_FLUSH_INTERVAL", "5.0"))
+CLICK_COUNTER_UPDATE_CHUNK = 1000
+
+PENDING_KEY = "clicks:pending:{shard}"
+FLUSHING_KEY = "clicks:flushing:{shard}"
+FLUSH_BATCH_KEY = "clicks:flushing_batch:{shard}"
+FLUSH_LOCK_KEY = "clicks:flush_lock"
+FLUSH_LOCK_TTL = 60
+COUNTED_BATCH_KEY = "clicks:counted:{batch_id}"
+COUNTED_BATCH_TTL = 3600
+INCREMENT_ATTEMPTS = 2
+
+# Drops a flushing hash once click_flushes says it was applied, then moves pending clicks into a new
+# batch if none is left. Returns the id of the batch waiting to be applied, if any.
+# KEYS: pending, flushing, batch id; ARGV: batch id applied for this shard, id for a new batch.
+START_FLUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    local current = redis.call('GET', KEYS[3])
+    if not current then
+        redis.call('SET', KEYS[3], ARGV[2])
+        return ARGV[2]
+    end
+    if current ~= ARGV[1] then
+        return current
+    end
+    redis.call('DEL', KEYS[2], KEYS[3])
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('SET', KEYS[3], ARGV[2])
+return ARGV[2]
+"""
+
+# Adds one click batch to the pending hashes unless that batch id was already counted, so a retry
+# after a lost reply never counts it twice.
+# KEYS: counted marker, then a pending hash per code; ARGV: marker TTL, then code and clicks per key.
+INCREMENT_SCRIPT = """
+if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('HINCRBY', KEYS[i], ARGV[2 * i - 2], ARGV[2 * i - 1])
+end
+return 1
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+urls_table = URL.__table__
+click_flushes_table = ClickFlush.__table__
+start_flush_script = redis_client.register_script(START_FLUSH_SCRIPT)
+increment_script = redis_client.register_script(INCREMENT_SCRIPT)
+release_lock_script = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+
+def redis_counters_enabled() -> bool:
+    return CLICK_COUNTER_MODE == "redis"
+
+def increment_click_counts(click_totals: dict, batch_id: str = None) -> bool:
+    """Add click deltas to Redis, spreading each code over a random shard - returns False if Redis is unavailable
+
+    Call it only once the clicks are committed. The batch id makes a retried call a no-op when
+    an earlier attempt already went through.
+    """
+    keys = [COUNTED_BATCH_KEY.format(batch_id=batch_id or uuid.uuid4().hex)]
+    args = [COUNTED_BATCH_TTL]
+    for short_code, clicks in click_totals.items():
+        keys.append(PENDING_KEY.format(shard=random.randrange(CLICK_COUNTER_SHARDS)))
+        args.extend([short_code, clicks])
+
+    for attempt in range(INCREMENT_ATTEMPTS):
+        try:
+            increment_script(keys=keys, args=args)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not increment click counters in Redis (attempt {attempt + 1}): {e}")
+    return False
+
+def get_applied_click_batches(db) -> dict:
+    """Shard -> id of the last counter batch folded into urls.click_count
+
+    Read it in the same transaction as the click counts it is passed along with, so both come
+    from one snapshot.
+    """
+    if not redis_counters_enabled():
+        return {}
+    return dict(db.execute(select(click_flushes_table.c.shard, click_flushes_table.c.batch_id)).all())
+
+def get_pending_click_counts(short_codes: list, applied_batches: dict) -> dict:
+    """Clicks recorded in Redis but not yet folded into urls.click_count
+
+    A flushing hash stays in Redis until the flush after the one that applied it, and is skipped
+    here once `applied_batches` (from get_applied_click_batches) shows it was applied.
+    """
+    if not short_codes or not redis_counters_enabled():
+        return {}
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for shard in range(CLICK_COUNTER_SHARDS):
+            pipe.hmget(PENDING_KEY.format(shard=shard), short_codes)
+            pipe.hmget(FLUSHING_KEY.format(shard=shard), short_codes)
+            pipe.get(FLUSH_BATCH_KEY.format(shard=shard))
+        results = pipe.execute()
+
+        pending = dict.fromkeys(short_codes, 0)
+        for shard in range(CLICK_COUNTER_SHARDS):
+            pending_values, flushing_values, batch_id = results[shard * 3:shard * 3 + 3]
+            shard_values = [pending_values]
+            if batch_id is None or batch_id.decode() != applied_batches.get(shard):
+                shard_values.append(flushing_values)
+            for values in shard_values:
+                for short_code, value in zip(short_codes, values):
+                    if value:
+                        pending[short_code] += int(value)
+        return pending
+    except Exception as e:
+        logger.warning(f"Could not read pending click counts: {e}")
+        return {}
+
+def get_live_click_count(short_code: str, persisted_count: int, applied_batches: dict) -> int:
+    """Persisted click count plus anything still pending in Redis"""
+    return (persisted_count or 0) + get_pending_click_counts([short_code], applied_batches).get(short_code, 0)
+
+def apply_click_counts(click_totals: dict, db):
+    """Fold click deltas into urls.click_count with one multi-row UPDATE per chunk"""
+    codes = list(click_totals)
+    for start in range(0, len(codes), CLICK_COUNTER_UPDATE_CHUNK):
+        chunk = codes[start:start + CLICK_COUNTER_UPDATE_CHUNK]
+        deltas = case({code: click_totals[code] for code in chunk}, value=urls_table.c.short_code, else_=0)
+        db.execute(
+            update(urls_table)
+            .where(urls_table.c.short_code.in_(chunk))
+            .values(click_count=urls_table.c.click_count + deltas)
+        )
+
+def flush_click_counts() -> int:
+    """Move pending Redis counters into MySQL - returns the number of clicks folded"""
+    # One worker folds counters at a time; batch ids in click_flushes keep a retried or overlapping
+    # flush (e.g. after the lock expired mid-flush) from applying a batch twice.
+    token = uuid.uuid4().hex
+    if not redis_client.set(FLUSH_LOCK_KEY, token, nx=True, ex=FLUSH_LOCK_TTL):
+        return 0
+    try:
+        return _flush_shards()
+    finally:
+        release_lock_script(keys=[FLUSH_LOCK_KEY], args=[token])
+
+def commit_click_counts(click_totals: dict, db):
+    """Fold already committed clicks into urls.click_count when Redis could not take them"""
+    apply_click_counts(click_totals, db)
+    db.commit()
+
+def ensure_click_flush_rows(db):
+    """Give every shard a click_flushes row, so applying a batch is always a conditional UPDATE"""
+    rows = [{"shard": shard, "batch_id": ""} for shard in range(CLICK_COUNTER_SHARDS)]
+    if db.get_bind().dialect.name == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(click_flushes_table).prefix_with("IGNORE")
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        statement = insert(click_flushes_table).on_conflict_do_nothing(index_elements=["shard"])
+    db.execute(statement, rows)
+    db.commit()
+
+def apply_click_batch(shard: int, batch_id: str, click_totals: dict, db) -> bool:
+    """Fold one shard's batch and record it as applied in the same transaction - False if it already was"""
+    # The UPDATE also locks the shard's row, so an overlapping flush waits here and then skips.
+    claimed = db.execute(
+        update(click_flushes_table)
+        .where(click_flushes_table.c.shard == shard, click_flushes_table.c.batch_id != batch_id)
+        .values(batch_id=batch_id)
+    ).rowcount
+    if not claimed:
+        db.rollback()
+        return False
+    apply_click_counts(click_totals, db)
+    db.commit()
+    return True
+
+def _flush_shards() -> int:
+    folded = 0
+    db = SessionLocal()
+    try:
+        ensure_click_flush_rows(db)
+        applied = get_applied_click_batches(db)
+        db.commit()
+
+        for shard in range(CLICK_COUNTER_SHARDS):
+            pending_key = PENDING_KEY.format(shard=shard)
+            flushing_key = FLUSHING_KEY.format(shard=shard)
+            batch_key = FLUSH_BATCH_KEY.format(shard=shard)
+
+            # A batch that is still unapplied (an earlier flush failed) is retried before taking more.
+            batch_id = start_flush_script(keys=[pending_key, flushing_key, batch_key],
+                                          args=[applied.get(shard, ""), uuid.uuid4().hex])
+            if not batch_id:
+                continue
+            batch_id = batch_id.decode()
+
+            raw_counts = redis_client.hgetall(flushing_key)
+            click_totals = {code.decode('utf-8'): int(clicks) for code, clicks in raw_counts.items() if int(clicks)}
+
+            try:
+                if apply_click_batch(shard, batch_id, click_totals, db):
+                    folded += sum(click_totals.values())
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Failed to flush click counters for shard {shard}: {e}")
+    finally:
+        db.close()
+
+    return folded
+
+class ClickCounterReconciler:
+    """Background thread that periodically flushes Redis click counters to MySQL"""
+
+    def __init__(self, interval=CLICK_COUNTER_FLUSH_INTERVAL):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.worker = None
+        self.total_folded = 0
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="click-counter-reconciler", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        if not self.worker:
+            return
+        self.stopped.set()
+        self.worker.join(self.interval + 5)
+        self.worker = None
+        self._flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._flush()
+
+    def _flush(self):
+        try:
+            self.total_folded += flush_click_counts()
+        except Exception as e:
+            logger.error(f"Click counter reconciliation failed: {e}")
+
+click_counter_reconciler = ClickCounterReconciler()
+
+def start_click_counter_reconciler():
+    if redis_counters_enabled():
+        click_counter_reconciler.start()
+
+def stop_click_counter_reconciler():
+    if redis_counters_enabled():
+        click_counter_reconciler.stop()
@@ -0,0 +1,63 @@
+import io
+import csv
+import json
+import logging
+from sqlalchemy import select
+from database import open_read_session, URL, Analytics
+from intern_service import join_click_strings, CLICK_USER_AGENT, CLICK_REFERER
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_FETCH_SIZE = 1000
+EXPORT_COLUMNS = ["short_code", "clicked_at", "user_agent", "referer"]
+
+def build_click_export_query(user_id: int, short_code: str = None):
+    """Raw clicks for one of the user's URLs, or for all of them"""
+    query = join_click_strings(select(Analytics.short_code, Analytics.clicked_at, CLICK_USER_AGENT, CLICK_REFERER))
+    if short_code:
+        query = query.where(Analytics.short_code == short_code)
+    else:
+        query = query.join(URL, URL.short_code == Analytics.short_code).where(URL.user_id == user_id)
+    return query.order_by(Analytics.id)
+
+def _format_rows(rows, export_format: str) -> str:
+    if export_format == "ndjson":
+        return "".join(
+            json.dumps({
+                "short_code": row.short_code,
+                "clicked_at": row.clicked_at.isoformat() if row.clicked_at else None,
+                "user_agent": row.user_agent,
+                "referer": row.referer
+            }) + "\n"
+            for row in rows
+        )
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row.short_code, row.clicked_at.isoformat() if row.clicked_at else "",
+                         row.user_agent or "", row.referer or ""])
+    return buffer.getvalue()
+
+def stream_click_export(user_id: int, short_code: str = None, export_format: str = "csv"):
+    """Yield the export in chunks from a server-side cursor, so memory stays flat for any click volume
+
+    This is a plain generator with its own (replica) session; StreamingResponse runs it in the threadpool.
+    """
+    if export_format == "csv":
+        yield ",".join(EXPORT_COLUMNS) + "\n"
+
+    db = open_read_session()
+    try:
+        result = db.execute(
+            build_click_export_query(user_id, short_code),
+            execution_options={"stream_results": True, "yield_per": EXPORT_FETCH_SIZE}
+        )
+        for rows in result.partitions():
+            yield _format_rows(rows, export_format)
+    except Exception as e:
+        logger.error(f"Click export failed for user {user_id}: {e}")
+        raise
+    finally:
+        db.close()
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import logging
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from database import Analytics, UserAgent, Referer
+from cache_service import LocalTTLCache
+
+logger = logging.getLogger(__name__)
+
+INTERN_CACHE_SIZE = int(os.getenv("INTERN_CACHE_SIZE", "10000"))
+# Ids never change once assigned, so entries only expire to bound memory held by rare values.
+INTERN_CACHE_TTL = float(os.getenv("INTERN_CACHE_TTL", "86400"))
+
+CLICK_USER_AGENT = UserAgent.value.label("user_agent")
+CLICK_REFERER = Referer.value.label("referer")
+
+def get_value_hash(value: str) -> bytes:
+    """16-byte MD5 digest used as the unique key of a lookup table row - matches UNHEX(MD5(value))"""
+    return hashlib.md5(value.encode()).digest()
+
+def join_click_strings(query):
+    """Outer-join the user agent and referer lookup tables onto a query over analytics"""
+    return query.outerjoin(UserAgent, UserAgent.id == Analytics.user_agent_id).outerjoin(
+        Referer, Referer.id == Analytics.referer_id
+    )
+
+class StringInterner:
+    """Maps repetitive strings to small integer ids in a lookup table, caching the mapping in-process"""
+
+    def __init__(self, model, cache_size: int = INTERN_CACHE_SIZE):
+        self.model = model
+        self.ids = LocalTTLCache(cache_size, INTERN_CACHE_TTL)
+
+    def get_ids(self, values, db) -> dict:
+        """Id for each distinct non-empty value, adding unseen values to the table - empty values have no id"""
+        ids = {}
+        missing = set()
+        for value in set(values):
+            if not value:
+                continue
+            value_id = self.ids.get(value)
+            if value_id is None:
+                missing.add(value)
+            else:
+                ids[value] = value_id
+
+        if missing:
+            for value, value_id in self._load_or_insert(missing, db).items():
+                self.ids.set(value, value_id)
+                ids[value] = value_id
+        return ids
+
+    def _select_ids(self, db, value_hashes) -> dict:
+        return dict(db.execute(
+            select(self.model.value_hash, self.model.id).where(self.model.value_hash.in_(value_hashes))
+        ).all())
+
+    def _load_or_insert(self, values: set, db) -> dict:
+        # New values are committed in their own short transaction on the same engine, so a click
+        # write that rolls back never leaves ids cached for rows that don't exist.
+        by_hash = {get_value_hash(value): value for value in values}
+        with Session(bind=db.get_bind()) as intern_db:
+            found = self._select_ids(intern_db, list(by_hash))
+            new_rows = [{"value_hash": value_hash, "value": value}
+                        for value_hash, value in by_hash.items() if value_hash not in found]
+            if new_rows:
+                table = self.model.__table__
+                if intern_db.get_bind().dialect.name == "mysql":
+                    from sqlalchemy.dialects.mysql import insert
+                    statement = insert(table).prefix_with("IGNORE")
+                else:
+                    from sqlalchemy.dialects.sqlite import insert
+                    statement = insert(table).on_conflict_do_nothing(index_elements=["value_hash"])
+                # Another worker may insert the same value concurrently; its row wins and is read back.
+                intern_db.execute(statement, new_rows)
+                intern_db.commit()
+                found.update(self._select_ids(intern_db, [row["value_hash"] for row in new_rows]))
+        return {by_hash[value_hash]: value_id for value_hash, value_id in found.items()}
+
+user_agent_interner = StringInterner(UserAgent)
+referer_interner = StringInterner(Referer)
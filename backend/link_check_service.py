@@ -0,0 +1,99 @@
+import os
+import asyncio
+import logging
+from urllib.parse import urlsplit
+import httpx
+from cache_service import LocalTTLCache
+from url_service import canonicalize_url
+
+logger = logging.getLogger(__name__)
+
+LINK_CHECK_TIMEOUT = float(os.getenv("LINK_CHECK_TIMEOUT", "5"))
+LINK_CHECK_MAX_CONNECTIONS = int(os.getenv("LINK_CHECK_MAX_CONNECTIONS", "100"))
+LINK_CHECK_PER_HOST = int(os.getenv("LINK_CHECK_PER_HOST", "4"))
+LINK_CHECK_CACHE_SIZE = int(os.getenv("LINK_CHECK_CACHE_SIZE", "10000"))
+LINK_CHECK_CACHE_TTL = float(os.getenv("LINK_CHECK_CACHE_TTL", "300"))
+LINK_CHECK_FAILURE_TTL = float(os.getenv("LINK_CHECK_FAILURE_TTL", "30"))
+
+class LinkChecker:
+    """Reachability checks on one pooled async HTTP client, with per-host limits and a result cache"""
+
+    def __init__(self, timeout=LINK_CHECK_TIMEOUT, max_connections=LINK_CHECK_MAX_CONNECTIONS,
+                 per_host=LINK_CHECK_PER_HOST):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.results = LocalTTLCache(LINK_CHECK_CACHE_SIZE, LINK_CHECK_CACHE_TTL)
+        self.client = None
+        self.host_slots = {}
+        self.in_flight = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop.
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections // 2)
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def check(self, url: str) -> dict:
+        """Check one URL - concurrent checks of the same URL share a single request"""
+        try:
+            parsed = urlsplit(url)
+            if parsed.scheme not in ("http", "https") or not parsed.netloc:
+                return {"valid": False, "message": "Invalid URL format"}
+            cache_key = canonicalize_url(url)
+        except ValueError:
+            return {"valid": False, "message": "Invalid URL format"}
+        result = self.results.get(cache_key)
+        if result:
+            return result
+
+        task = self.in_flight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._check_and_cache(cache_key, url, parsed.hostname))
+            self.in_flight[cache_key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(cache_key, None))
+        return await asyncio.shield(task)
+
+    async def check_many(self, urls: list) -> list:
+        return await asyncio.gather(*(self.check(url) for url in urls))
+
+    async def _check_and_cache(self, cache_key: str, url: str, host: str) -> dict:
+        result, ttl = await self._request(url, host)
+        self.results.set(cache_key, result, ttl)
+        return result
+
+    async def _request(self, url: str, host: str) -> tuple:
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = [asyncio.Semaphore(self.per_host), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                response = await self._get_client().head(url)
+            if response.status_code < 400:
+                return {"valid": True, "message": "URL is reachable"}, LINK_CHECK_CACHE_TTL
+            return {"valid": False, "message": f"URL returned status {response.status_code}"}, LINK_CHECK_CACHE_TTL
+        except httpx.InvalidURL:
+            return {"valid": False, "message": "Invalid URL format"}, LINK_CHECK_CACHE_TTL
+        except httpx.HTTPError:
+            return {"valid": True, "message": "URL format is valid (reachability check failed)"}, LINK_CHECK_FAILURE_TTL
+        except Exception as e:
+            # Anything else (bad ports, unsupported schemes, encoding errors) fails this entry, not the whole batch.
+            logger.warning(f"Reachability check failed for {url}: {e}")
+            return {"valid": True, "message": "URL format is valid (reachability check failed)"}, LINK_CHECK_FAILURE_TTL
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                self.host_slots.pop(host, None)
+
+link_checker = LinkChecker()
@@ -1,23 +1,52 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
-from pydantic import BaseModel, HttpUrl, EmailStr
-import redis
+from pydantic import BaseModel, HttpUrl, EmailStr, ValidationError
 import json
+import orjson
 import os
-from datetime import datetime
+import hashlib
+from datetime import datetime, timedelta
 import logging
 
-from database import get_database_session, User, URL, Analytics, get_current_time_ist
-from auth_service import get_logged_in_user, create_user_account, authenticate_user_login
-from url_service import create_short_url, get_user_urls, soft_delete_url, record_url_click
+from database import (get_request_session, get_request_read_session, open_request_session, run_with_session,
+                      mark_recent_write, get_current_time_ist, to_naive_ist, engine)
+from auth_service import (get_logged_in_user, get_logged_in_user_id, SessionPrincipal, create_user_account,
+                          authenticate_user_login, deactivate_user_account)
+from url_service import (create_short_url, create_short_urls_batch, get_user_urls, get_user_urls_page, get_user_url, get_click_history, soft_delete_url,
+                         render_qr_code)
+from code_service import code_allocator
+from click_service import track_url_click, click_queue, start_click_ingestion, stop_click_ingestion
+from cache_service import (resolve_short_code, cache_redirect_target, invalidate_redirect, invalidate_redirects, invalidate_principal, redirect_invalidation_listener,
+                           qr_image_cache, redirect_cache, principal_cache, get_url_list_cache_key, get_analytics_cache_key, invalidate_user_caches,
+                           run_blocking, load_through_cache, get_cached_etag, get_payload_etag, URL_LIST_CACHE_TTL, ANALYTICS_CACHE_TTL, NOT_FOUND, EXPIRED)
+from export_service import stream_click_export, EXPORT_FORMATS
+from reaper_service import lifecycle_reaper
+from link_check_service import link_checker
+from code_filter_service import short_code_filter
+from intern_service import user_agent_interner, referer_interner
+from redirect_snapshot_service import redirect_snapshot
+from metrics_service import MetricsMiddleware, render_metrics
+from rate_limit_service import rate_limited, rate_limiter
+from profiling_service import ProfilingMiddleware, request_profiler, render_folded_stacks, PROFILE_TOKEN
+from rollup_service import analytics_rollup_worker, get_click_series, BUCKETS, MAX_SERIES_BUCKETS
+from counter_service import (get_applied_click_batches, get_pending_click_counts, get_live_click_count,
+                             click_counter_reconciler, start_click_counter_reconciler, stop_click_counter_reconciler)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_client = redis.from_url(REDIS_URL)
+QR_RENDER_VERSION = 1
+MAX_URL_PAGE_SIZE = 500
+BATCH_SHORTEN_MAX_ITEMS = int(os.getenv("BATCH_SHORTEN_MAX_ITEMS", "100000"))
+BATCH_SHORTEN_CHUNK_SIZE = int(os.getenv("BATCH_SHORTEN_CHUNK_SIZE", "1000"))
+CHECK_URL_BATCH_MAX_ITEMS = int(os.getenv("CHECK_URL_BATCH_MAX_ITEMS", "100"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Dashboard responses may be kept by the browser but must be revalidated with If-None-Match.
+DASHBOARD_CACHE_CONTROL = "private, no-cache"
+QR_MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
 
 class UserRegistration(BaseModel):
     name: str
@@ -40,6 +69,10 @@ class CreateShortURL(BaseModel):
     expires_in_days: int = None
     use_existing_code: bool = False
 
+class CheckURLBatch(BaseModel):
+    # Plain strings, so one malformed URL is reported in its own result instead of failing the batch.
+    urls: list[str]
+
 class ShortURLResponse(BaseModel):
     id: int
     original_url: str
@@ -68,15 +101,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Only installed when a trigger is configured, so requests pay nothing for it otherwise.
+if request_profiler.enabled:
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# Outermost, so latency includes the session and CORS middleware.
+app.add_middleware(MetricsMiddleware)
+
+@app.on_event("startup")
+async def start_background_workers():
+    start_click_ingestion()
+    start_click_counter_reconciler()
+    redirect_invalidation_listener.start()
+    analytics_rollup_worker.start()
+    lifecycle_reaper.start()
+    short_code_filter.start()
+    redirect_snapshot.start()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    stop_click_ingestion()
+    stop_click_counter_reconciler()
+    redirect_invalidation_listener.stop()
+    analytics_rollup_worker.stop()
+    lifecycle_reaper.stop()
+    short_code_filter.stop()
+    redirect_snapshot.stop()
+    await link_checker.close()
+
 @app.get("/")
 async def health_check():
     return {"message": "URL Shortener API is running", "version": "2.0.0"}
 
 @app.post("/api/register", response_model=UserProfile)
-async def register_new_user(user_data: UserRegistration, db = Depends(get_database_session)):
+async def register_new_user(user_data: UserRegistration, db = Depends(get_request_session)):
     """Register a new user account"""
     try:
-        new_user = create_user_account(user_data.name, user_data.email, user_data.password, db)
+        new_user = await run_with_session(db, create_user_account, user_data.name, user_data.email, user_data.password)
         
         return UserProfile(
             id=new_user.id,
@@ -92,10 +153,10 @@ async def register_new_user(user_data: UserRegistration, db = Depends(get_databa
         raise HTTPException(status_code=500, detail="Registration service temporarily unavailable. Please try again later.")
 
 @app.post("/api/login")
-async def login_user(user_data: UserLogin, request: Request, db = Depends(get_database_session)):
+async def login_user(user_data: UserLogin, request: Request, db = Depends(get_request_session)):
     """Login user and create session"""
     try:
-        user = authenticate_user_login(user_data.email, user_data.password, db)
+        user = await run_with_session(db, authenticate_user_login, user_data.email, user_data.password)
         
         request.session["user_id"] = user.id
         
@@ -120,8 +181,95 @@ async def logout_user(request: Request):
     request.session.clear()
     return {"message": "Logout successful"}
 
+@app.post("/api/account/deactivate")
+async def deactivate_account(request: Request, user_id: int = Depends(get_logged_in_user_id),
+                             db = Depends(get_request_session)):
+    """Deactivate the logged-in account and end its sessions on every worker"""
+    try:
+        await run_with_session(db, deactivate_user_account, user_id)
+        await run_blocking(invalidate_principal, user_id)
+        request.session.clear()
+        return {"message": "Account deactivated"}
+        
+    except Exception as e:
+        logger.error(f"Account deactivation failed for user {user_id}: {e}")
+        raise HTTPException(status_code=500, detail="Account deactivation failed")
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    """Prometheus metrics for this worker process"""
+    # nginx forwards every /<alphanumeric> path here, so metrics are only served with a token.
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Metrics are not enabled")
+    if request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    
+    queue_stats = click_queue.get_stats()
+    reaper_stats = lifecycle_reaper.get_stats()
+    filter_stats = short_code_filter.get_stats()
+    snapshot_stats = redirect_snapshot.get_stats()
+    gauges = {
+        "click_queue_depth": ("Click events waiting to be written", queue_stats["queued"]),
+        "click_queue_dropped": ("Click events dropped because the queue was full", queue_stats["dropped"]),
+        "click_queue_written": ("Click events written to analytics", queue_stats["written"]),
+        "click_queue_failed_batches": ("Click batches that failed to write", queue_stats["failed"]),
+        "click_counters_folded": ("Redis click deltas folded into urls.click_count", click_counter_reconciler.total_folded),
+        "reaper_runs": ("Completed lifecycle reaper passes", reaper_stats["runs"]),
+        "reaper_expired_urls": ("URLs deactivated after expiry", reaper_stats["expired_urls"]),
+        "reaper_purged_urls": ("Soft-deleted URLs permanently removed", reaper_stats["purged_urls"]),
+        "reaper_failures": ("Lifecycle reaper passes that failed", reaper_stats["failures"]),
+        "reaper_last_run_seconds": ("Duration of the last reaper pass", reaper_stats["last_run_seconds"]),
+        "redirect_cache_entries": ("Entries in the in-process redirect cache", len(redirect_cache.entries)),
+        "principal_cache_entries": ("Entries in the in-process session principal cache", len(principal_cache.entries)),
+        "user_agent_id_cache_entries": ("User agent ids cached in-process", len(user_agent_interner.ids)),
+        "referer_id_cache_entries": ("Referer ids cached in-process", len(referer_interner.ids)),
+        "short_code_filter_ready": ("1 once the short code filter is loaded", int(filter_stats["ready"])),
+        "short_code_filter_items": ("Codes in the short code filter", filter_stats["items"]),
+        "short_code_filter_capacity": ("Codes the filter holds at its target false-positive rate", filter_stats["capacity"]),
+        "short_code_filter_memory_bytes": ("Memory used by the short code filter bit array", filter_stats["memory_bytes"]),
+        "short_code_filter_estimated_fpr": ("Estimated false-positive rate at the current fill",
+                                           filter_stats["estimated_false_positive_rate"]),
+        "short_code_filter_rejected": ("Redirects rejected by the filter without a lookup", filter_stats["rejected"]),
+        "short_code_filter_passed": ("Redirects the filter let through to a lookup", filter_stats["passed"]),
+        "redirect_snapshot_entries": ("Codes in the mapped redirect snapshot", snapshot_stats["entries"]),
+        "redirect_snapshot_bytes": ("Size of the mapped redirect snapshot file", snapshot_stats["bytes"]),
+        "redirect_snapshot_age_seconds": ("Seconds since the mapped redirect snapshot was built",
+                                          snapshot_stats["age_seconds"]),
+        "redirect_snapshot_invalidated": ("Codes changed since the snapshot was built, served from Redis instead",
+                                          snapshot_stats["invalidated"]),
+        "rate_limit_local_leases": ("Rate limit keys with tokens leased to this worker", len(rate_limiter.leases)),
+        "rate_limit_local_denials": ("Rate limit keys this worker rejects without asking Redis", len(rate_limiter.denied)),
+        "request_profiles_captured": ("Request profiles stored since startup", request_profiler.captured),
+        "db_pool_checked_out": ("Connections currently checked out of the pool",
+                                getattr(engine.pool, "checkedout", lambda: None)()),
+    }
+    return PlainTextResponse(render_metrics(gauges), media_type="text/plain; version=0.0.4")
+
+def require_profile_token(request: Request):
+    if not PROFILE_TOKEN:
+        raise HTTPException(status_code=404, detail="Profiling is not enabled")
+    if request.headers.get("authorization") != f"Bearer {PROFILE_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid profiling token")
+
+@app.get("/admin/profiles")
+async def list_request_profiles(request: Request):
+    """Most recent request profiles in this worker, newest first"""
+    require_profile_token(request)
+    return request_profiler.list_profiles()
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_request_profile(profile_id: int, request: Request, format: str = "json"):
+    """One request profile, as JSON or as folded stacks for flame-graph tools (`?format=folded`)"""
+    require_profile_token(request)
+    profile = request_profiler.get_profile(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found (it may have left the buffer)")
+    if format == "folded":
+        return PlainTextResponse(render_folded_stacks(profile))
+    return profile
+
 @app.get("/api/me", response_model=UserProfile)
-async def get_current_user_profile(current_user: User = Depends(get_logged_in_user)):
+async def get_current_user_profile(current_user: SessionPrincipal = Depends(get_logged_in_user)):
     """Get current user information"""
     return UserProfile(
         id=current_user.id,
@@ -130,55 +278,50 @@ async def get_current_user_profile(current_user: User = Depends(get_logged_in_us
         created_at=current_user.created_at
     )
 
-@app.post("/api/check-url")
-async def check_url_validity(url_data: CreateShortURL, current_user: User = Depends(get_logged_in_user)):
+@app.post("/api/check-url", dependencies=[Depends(rate_limited("check_url"))])
+async def check_url_validity(url_data: CreateShortURL, user_id: int = Depends(get_logged_in_user_id)):
     """Check if URL is valid and reachable"""
     try:
-        import requests
-        from urllib.parse import urlparse
-        
-        original_url = str(url_data.url)
-        
-        parsed = urlparse(original_url)
-        if not parsed.scheme or not parsed.netloc:
-            return {"valid": False, "message": "Invalid URL format"}
-        
-        try:
-            response = requests.head(original_url, timeout=5, allow_redirects=True)
-            if response.status_code < 400:
-                return {"valid": True, "message": "URL is reachable"}
-            else:
-                return {"valid": False, "message": f"URL returned status {response.status_code}"}
-        except requests.exceptions.RequestException:
-            return {"valid": True, "message": "URL format is valid (reachability check failed)"}
-            
+        return await link_checker.check(str(url_data.url))
     except Exception as e:
         logger.warning(f"URL check failed: {e}")
         return {"valid": True, "message": "URL format appears valid"}
 
-@app.post("/api/shorten", response_model=ShortURLResponse)
-async def shorten_new_url(url_data: CreateShortURL, current_user: User = Depends(get_logged_in_user), 
-                         db = Depends(get_database_session)):
+@app.post("/api/check-url/batch", dependencies=[Depends(rate_limited("check_url"))])
+async def check_url_batch(batch: CheckURLBatch, user_id: int = Depends(get_logged_in_user_id)):
+    """Check many URLs concurrently, returning results in request order"""
+    if len(batch.urls) > CHECK_URL_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {CHECK_URL_BATCH_MAX_ITEMS} URLs per batch")
+    
+    try:
+        results = await link_checker.check_many(batch.urls)
+        return {"results": [{"url": url, **result} for url, result in zip(batch.urls, results)]}
+    except Exception as e:
+        logger.warning(f"Batch URL check failed: {e}")
+        raise HTTPException(status_code=500, detail="URL check temporarily unavailable")
+
+@app.post("/api/shorten", response_model=ShortURLResponse, dependencies=[Depends(rate_limited("shorten"))])
+async def shorten_new_url(url_data: CreateShortURL, request: Request, user_id: int = Depends(get_logged_in_user_id), 
+                         db = Depends(get_request_session)):
     """Create a new short URL"""
     try:
         original_url = str(url_data.url)
         
-        url_record = create_short_url(
+        await run_blocking(code_allocator.reserve, 1)
+        url_record = await run_with_session(
+            db,
+            create_short_url,
             original_url=original_url,
-            user_id=current_user.id,
+            user_id=user_id,
             custom_code=url_data.custom_code,
-            expires_in_days=url_data.expires_in_days,
-            db=db
+            expires_in_days=url_data.expires_in_days
         )
         
-        redis_client.setex(f"short:{url_record.short_code}", 3600, original_url)
+        await run_blocking(short_code_filter.add, [url_record.short_code])
+        await run_blocking(cache_redirect_target, url_record)
         
-        try:
-            cache_keys = redis_client.keys("urls_list:*")
-            if cache_keys:
-                redis_client.delete(*cache_keys)
-        except Exception as cache_error:
-            logger.warning(f"Cache invalidation failed: {cache_error}")
+        await run_blocking(invalidate_user_caches, user_ids=[user_id])
+        mark_recent_write(request)
         
         return ShortURLResponse(
             id=url_record.id,
@@ -189,7 +332,7 @@ async def shorten_new_url(url_data: CreateShortURL, current_user: User = Depends
             expires_at=url_record.expires_at,
             click_count=url_record.click_count,
             is_active=True,
-            qr_code=url_record.qr_code
+            qr_code=f"http://localhost:8080/api/qr/{url_record.short_code}"
         )
         
     except HTTPException:
@@ -198,31 +341,106 @@ async def shorten_new_url(url_data: CreateShortURL, current_user: User = Depends
         logger.error(f"URL shortening failed: {e}")
         raise HTTPException(status_code=500, detail="URL shortening service unavailable")
 
-@app.get("/{short_code}")
-async def redirect_to_original_url(short_code: str, request: Request, db = Depends(get_database_session)):
+def parse_batch_items(body: bytes, content_type: str) -> list:
+    """Split a batch upload into raw items - a JSON array, or one JSON object per line for NDJSON"""
+    if "ndjson" in content_type or "jsonlines" in content_type:
+        items = []
+        for line in body.splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+    
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError("Expected a JSON array")
+    return items
+
+async def shorten_batch_chunk(chunk: list, chunk_start: int, user_id: int, db) -> str:
+    """Create one chunk of a batch upload and render its NDJSON result lines"""
+    results = [None] * len(chunk)
+    entries, entry_positions = [], []
+    
+    for position, item in enumerate(chunk):
+        try:
+            url_data = CreateShortURL.model_validate(item)
+            entries.append((str(url_data.url), url_data.custom_code, url_data.expires_in_days))
+            entry_positions.append(position)
+        except ValidationError:
+            results[position] = {'status': 'error', 'detail': 'Invalid item'}
+    
+    if entries:
+        try:
+            await run_blocking(code_allocator.reserve, len(entries))
+            created = await run_with_session(db, create_short_urls_batch, entries, user_id)
+            await run_blocking(short_code_filter.add,
+                               [result['short_code'] for result in created if result['status'] == 'created'])
+        except Exception as e:
+            logger.error(f"Batch shortening failed: {e}")
+            created = [{'original_url': entry[0], 'status': 'error', 'detail': 'Could not create URL'}
+                       for entry in entries]
+        for position, result in zip(entry_positions, created):
+            results[position] = result
+        
+        # Invalidate as each chunk commits, so a client that disconnects mid-stream leaves no stale caches.
+        # Every new code is cleared, since a lookup before creation may have cached a 404 for it.
+        try:
+            await run_blocking(invalidate_redirects,
+                               [result['short_code'] for result in created if result['status'] == 'created'])
+        except Exception as cache_error:
+            logger.warning(f"Failed to invalidate redirect cache for a batch chunk: {cache_error}")
+        await run_blocking(invalidate_user_caches, user_ids=[user_id])
+    
+    lines = []
+    for position, result in enumerate(results):
+        result = {'index': chunk_start + position, **result}
+        if 'short_code' in result:
+            result['short_url'] = f"http://localhost:8080/{result['short_code']}"
+        lines.append(json.dumps(result) + "\n")
+    return "".join(lines)
+
+@app.post("/api/shorten/batch", dependencies=[Depends(rate_limited("shorten_batch"))])
+async def shorten_urls_batch(request: Request, user_id: int = Depends(get_logged_in_user_id)):
+    """Create many short URLs from a JSON array or NDJSON upload, streaming one NDJSON result per item"""
+    try:
+        items = parse_batch_items(await request.body(), request.headers.get("content-type", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    
+    if len(items) > BATCH_SHORTEN_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_SHORTEN_MAX_ITEMS} URLs per batch")
+    
+    mark_recent_write(request)
+    
+    async def stream_results():
+        # The body is streamed after the endpoint returns, when route-scoped sessions may be closed.
+        async with open_request_session() as db:
+            for chunk_start in range(0, len(items), BATCH_SHORTEN_CHUNK_SIZE):
+                yield await shorten_batch_chunk(items[chunk_start:chunk_start + BATCH_SHORTEN_CHUNK_SIZE],
+                                                chunk_start, user_id, db)
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.get("/{short_code}", dependencies=[Depends(rate_limited("redirect"))])
+async def redirect_to_original_url(short_code: str, request: Request, db = Depends(get_request_read_session),
+                                   write_db = Depends(get_request_session)):
     """Redirect short URL to original URL"""
+    if not short_code_filter.might_contain(short_code):
+        raise HTTPException(status_code=404, detail="Short URL not found")
+    
     try:
-        cached_url = redis_client.get(f"short:{short_code}")
-        original_url = None
-        
-        if cached_url:
-            original_url = cached_url.decode('utf-8')
-        else:
-            url_record = db.query(URL).filter(URL.short_code == short_code, URL.is_active == True).first()
-            if not url_record:
-                raise HTTPException(status_code=404, detail="Short URL not found")
-            
-            if url_record.expires_at and url_record.expires_at < get_current_time_ist():
-                raise HTTPException(status_code=410, detail="This URL has expired")
-            
-            original_url = url_record.original_url
-            
-            redis_client.setex(f"short:{short_code}", 3600, original_url)
+        status, original_url = await resolve_short_code(short_code, db)
+        if status == NOT_FOUND:
+            raise HTTPException(status_code=404, detail="Short URL not found")
+        if status == EXPIRED:
+            raise HTTPException(status_code=410, detail="This URL has expired")
         
         try:
             user_agent = request.headers.get("user-agent", "")
             referer = request.headers.get("referer", "")
-            record_url_click(short_code, user_agent, referer, db)
+            await track_url_click(short_code, user_agent, referer, write_db)
         except Exception as analytics_error:
             logger.error(f"Analytics recording failed: {analytics_error}")
         
@@ -234,61 +452,95 @@ async def redirect_to_original_url(short_code: str, request: Request, db = Depen
         logger.error(f"Redirect failed for {short_code}: {e}")
         raise HTTPException(status_code=500, detail="Redirect service unavailable")
 
-@app.get("/api/urls")
-async def list_user_urls(skip: int = 0, limit: int = 100, current_user: User = Depends(get_logged_in_user), 
-                        db = Depends(get_database_session)):
-    """Get paginated list of user's URLs"""
-    try:
-        cache_key = f"urls_list:{current_user.id}:{skip}:{limit}"
-        
+def serialize_url_rows(urls, pending_clicks: dict) -> list:
+    result = []
+    for url in urls:
+        result.append({
+            'id': url.id,
+            'original_url': url.original_url,
+            'short_code': url.short_code,
+            'short_url': f"http://localhost:8080/{url.short_code}",
+            'created_at': url.created_at.isoformat(),
+            'click_count': url.click_count + pending_clicks.get(url.short_code, 0),
+            'qr_code': f"http://localhost:8080/api/qr/{url.short_code}"
+        })
+    return result
+
+async def cached_json_response(request: Request, cache_key: str, load) -> Response:
+    """Serve a cached JSON body as stored, with its ETag, or 304 when the client already has it
+
+    `load` returns (encoded body, ttl). With no cache key (Redis down) the body is loaded directly.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if cache_key and if_none_match:
         try:
-            cached_result = redis_client.get(cache_key)
-            if cached_result:
-                logger.info("Returning cached URL list")
-                return json.loads(cached_result.decode('utf-8'))
+            etag = await get_cached_etag(cache_key)
         except Exception as redis_error:
             logger.warning(f"Redis error: {redis_error}")
+            etag = None
+        if etag == if_none_match:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": DASHBOARD_CACHE_CONTROL})
+    
+    body, _ = await (load_through_cache(cache_key, load, raw=True, with_etag=True) if cache_key else load())
+    return Response(content=body, media_type="application/json",
+                    headers={"ETag": get_payload_etag(body), "Cache-Control": DASHBOARD_CACHE_CONTROL})
+
+@app.get("/api/urls")
+async def list_user_urls(request: Request, skip: int = 0, limit: int = 100, cursor: str = None,
+                        user_id: int = Depends(get_logged_in_user_id), db = Depends(get_request_read_session)):
+    """Get paginated list of user's URLs
+
+    Passing `cursor` (empty for the first page) switches to keyset pagination and returns
+    `{"items": [...], "next_cursor": ...}` instead of a plain list.
+    """
+    try:
+        limit = max(1, min(limit, MAX_URL_PAGE_SIZE))
         
-        urls = get_user_urls(current_user.id, skip, limit, db)
-        
-        result = []
-        for url in urls:
-            result.append({
-                'id': url.id,
-                'original_url': url.original_url,
-                'short_code': url.short_code,
-                'short_url': f"http://localhost:8080/{url.short_code}",
-                'created_at': url.created_at.isoformat(),
-                'click_count': url.click_count,
-                'qr_code': url.qr_code
-            })
+        async def load():
+            if cursor is None:
+                urls = await run_with_session(db, get_user_urls, user_id, skip, limit)
+            else:
+                urls, next_cursor = await run_with_session(db, get_user_urls_page, user_id, cursor, limit)
+            applied_batches = await run_with_session(db, get_applied_click_batches)
+            pending_clicks = await run_blocking(get_pending_click_counts, [url.short_code for url in urls], applied_batches)
+            
+            result = serialize_url_rows(urls, pending_clicks)
+            if cursor is not None:
+                result = {'items': result, 'next_cursor': next_cursor}
+            return orjson.dumps(result), URL_LIST_CACHE_TTL
         
         try:
-            redis_client.setex(cache_key, 10, json.dumps(result))
+            if cursor is None:
+                cache_key = await get_url_list_cache_key(user_id, skip, limit)
+            else:
+                cache_key = await get_url_list_cache_key(user_id, "cursor", cursor, limit)
         except Exception as redis_error:
-            logger.warning(f"Failed to cache URL list: {redis_error}")
+            logger.warning(f"Redis error: {redis_error}")
+            cache_key = None
         
-        return result
+        return await cached_json_response(request, cache_key, load)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to list URLs: {e}")
         raise HTTPException(status_code=500, detail="Could not load URLs")
 
 @app.delete("/api/urls/{short_code}")
-async def delete_user_url(short_code: str, current_user: User = Depends(get_logged_in_user), 
-                         db = Depends(get_database_session)):
+async def delete_user_url(short_code: str, request: Request, user_id: int = Depends(get_logged_in_user_id), 
+                         db = Depends(get_request_session)):
     """Soft delete a URL with backup period"""
     try:
-        backup_until = soft_delete_url(short_code, current_user.id, db)
-        
-        redis_client.delete(f"short:{short_code}")
+        backup_until = await run_with_session(db, soft_delete_url, short_code, user_id)
         
+        # The code stays in the short code filter (Bloom filters can't delete) until its next rebuild;
+        # the negative redirect cache keeps those lookups cheap meanwhile.
         try:
-            cache_keys = redis_client.keys("urls_list:*")
-            if cache_keys:
-                redis_client.delete(*cache_keys)
+            await run_blocking(invalidate_redirect, short_code)
         except Exception as cache_error:
-            logger.warning(f"Cache invalidation failed: {cache_error}")
+            logger.warning(f"Failed to invalidate redirect cache for {short_code}: {cache_error}")
+        await run_blocking(invalidate_user_caches, user_ids=[user_id])
+        mark_recent_write(request)
         
         return {
             "message": "URL deleted successfully", 
@@ -303,46 +555,33 @@ async def delete_user_url(short_code: str, current_user: User = Depends(get_logg
         raise HTTPException(status_code=500, detail="Delete operation failed")
 
 @app.get("/api/analytics/{short_code}", response_model=AnalyticsData)
-async def get_url_analytics(short_code: str, current_user: User = Depends(get_logged_in_user), 
-                           db = Depends(get_database_session)):
+async def get_url_analytics(short_code: str, request: Request, user_id: int = Depends(get_logged_in_user_id), 
+                           db = Depends(get_request_read_session)):
     """Get analytics for a specific URL"""
     try:
-        url_record = db.query(URL).filter(URL.short_code == short_code, URL.user_id == current_user.id).first()
-        if not url_record:
-            raise HTTPException(status_code=404, detail="URL not found")
-        
-        cache_key = f"analytics:{short_code}"
-        cached_analytics = redis_client.get(cache_key)
-        
-        if cached_analytics:
-            analytics_data = json.loads(cached_analytics)
-        else:
-            analytics_records = db.query(Analytics).filter(
-                Analytics.short_code == short_code
-            ).order_by(Analytics.clicked_at.desc()).limit(100).all()
-            
-            click_history = []
-            for record in analytics_records:
-                click_history.append({
-                    'timestamp': record.clicked_at.isoformat() if record.clicked_at else None,
-                    'date': record.clicked_at.strftime('%Y-%m-%d') if record.clicked_at else None,
-                    'time': record.clicked_at.strftime('%H:%M:%S') if record.clicked_at else None,
-                    'user_agent': record.user_agent or 'Unknown',
-                    'referer': record.referer or 'Direct'
-                })
+        async def load():
+            # The cache key is per owner, so ownership only needs checking when the entry is filled.
+            url_record = await run_with_session(db, get_user_url, short_code, user_id)
+            if not url_record:
+                raise HTTPException(status_code=404, detail="URL not found")
             
+            click_history = await run_with_session(db, get_click_history, short_code)
+            applied_batches = await run_with_session(db, get_applied_click_batches)
             analytics_data = {
-                'total_clicks': url_record.click_count,
+                'short_code': short_code,
+                'total_clicks': await run_blocking(get_live_click_count, short_code, url_record.click_count,
+                                                   applied_batches),
                 'click_history': click_history
             }
-            
-            redis_client.setex(cache_key, 10, json.dumps(analytics_data, default=str))
+            return orjson.dumps(analytics_data), ANALYTICS_CACHE_TTL
         
-        return AnalyticsData(
-            short_code=short_code,
-            total_clicks=analytics_data['total_clicks'],
-            click_history=analytics_data['click_history']
-        )
+        try:
+            cache_key = await get_analytics_cache_key(short_code, user_id)
+        except Exception as redis_error:
+            logger.warning(f"Redis error: {redis_error}")
+            cache_key = None
+        
+        return await cached_json_response(request, cache_key, load)
         
     except HTTPException:
         raise
@@ -350,19 +589,89 @@ async def get_url_analytics(short_code: str, current_user: User = Depends(get_lo
         logger.error(f"Analytics failed for {short_code}: {e}")
         raise HTTPException(status_code=500, detail="Analytics service unavailable")
 
-@app.get("/api/qr/{short_code}")
-async def get_qr_code_for_url(short_code: str, db = Depends(get_database_session)):
-    """Get QR code for a short URL"""
+@app.get("/api/analytics/{short_code}/series")
+async def get_url_click_series(short_code: str, start: datetime = Query(None, alias="from"),
+                               end: datetime = Query(None, alias="to"), bucket: str = "day", user_id: int = Depends(get_logged_in_user_id),
+                               db = Depends(get_request_read_session)):
+    """Get click time series and breakdowns for a URL from the pre-aggregated rollups"""
     try:
-        url_record = db.query(URL).filter(URL.short_code == short_code, URL.is_active == True).first()
+        if bucket not in BUCKETS:
+            raise HTTPException(status_code=400, detail="Bucket must be 'hour' or 'day'")
+        
+        # Timestamps are stored as naive IST; an offset in the query is converted rather than compared as-is.
+        end = to_naive_ist(end) or get_current_time_ist()
+        start = to_naive_ist(start) or end - timedelta(days=30)
+        bucket_length = timedelta(hours=1) if bucket == "hour" else timedelta(days=1)
+        if start > end or (end - start) / bucket_length > MAX_SERIES_BUCKETS[bucket]:
+            raise HTTPException(status_code=400, detail="Requested range is empty or too large for this bucket size")
+        
+        url_record = await run_with_session(db, get_user_url, short_code, user_id)
         if not url_record:
             raise HTTPException(status_code=404, detail="URL not found")
         
-        return {
-            "short_code": short_code,
-            "qr_code": url_record.qr_code,
-            "short_url": f"http://localhost:8080/{short_code}"
-        }
+        return await run_with_session(db, get_click_series, short_code, start, end, bucket)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Click series failed for {short_code}: {e}")
+        raise HTTPException(status_code=500, detail="Analytics service unavailable")
+
+def click_export_response(user_id: int, short_code: str, export_format: str, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        stream_click_export(user_id, short_code, export_format),
+        media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{export_format}"'}
+    )
+
+@app.get("/api/analytics/{short_code}/export")
+async def export_url_clicks(short_code: str, format: str = "csv", user_id: int = Depends(get_logged_in_user_id),
+                            db = Depends(get_request_read_session)):
+    """Stream every recorded click for a URL as CSV or NDJSON"""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be 'csv' or 'ndjson'")
+    
+    url_record = await run_with_session(db, get_user_url, short_code, user_id)
+    if not url_record:
+        raise HTTPException(status_code=404, detail="URL not found")
+    
+    return click_export_response(user_id, short_code, format, f"clicks-{short_code}")
+
+@app.get("/api/export/analytics")
+async def export_account_clicks(format: str = "csv", user_id: int = Depends(get_logged_in_user_id)):
+    """Stream every recorded click across all of the user's URLs as CSV or NDJSON"""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be 'csv' or 'ndjson'")
+    
+    return click_export_response(user_id, None, format, "clicks")
+
+@app.get("/api/qr/{short_code}")
+async def get_qr_code_for_url(short_code: str, request: Request, format: str = "png",
+                              db = Depends(get_request_read_session)):
+    """Get QR code image for a short URL, rendered on first request"""
+    try:
+        if format not in QR_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail="Format must be 'png' or 'svg'")
+        
+        status, _ = await resolve_short_code(short_code, db)
+        if status == NOT_FOUND:
+            raise HTTPException(status_code=404, detail="URL not found")
+        if status == EXPIRED:
+            raise HTTPException(status_code=410, detail="This URL has expired")
+        
+        short_url = f"http://localhost:8080/{short_code}"
+        etag = '"' + hashlib.sha1(f"{QR_RENDER_VERSION}:{format}:{short_url}".encode()).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+        
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        
+        image = qr_image_cache.get(etag)
+        if image is None:
+            image = await run_in_threadpool(render_qr_code, short_url, format)
+            qr_image_cache.set(etag, image)
+        
+        return Response(content=image, media_type=QR_MEDIA_TYPES[format], headers=headers)
         
     except HTTPException:
         raise
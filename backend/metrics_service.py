@@ -0,0 +1,167 @@
+import time
+import bisect
+import threading
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# Default latency buckets in seconds, as used by the Prometheus client libraries.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: tuple = ()) -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(labelnames + extra[:1], labels + extra[1:])]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "Request latency by route template",
+                                  ("method", "route", "status"))
+HTTP_REQUEST_DB_QUERIES = Histogram("http_request_db_queries", "SQL statements executed per request",
+                                    ("route",), QUERY_COUNT_BUCKETS)
+HTTP_REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in SQL statements per request", ("route",))
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed, including background workers")
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "SQL statement execution time")
+DB_POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection")
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+
+METRICS = [HTTP_REQUEST_DURATION, HTTP_REQUEST_DB_QUERIES, HTTP_REQUEST_DB_SECONDS, DB_QUERIES, DB_QUERY_DURATION,
+           DB_POOL_CHECKOUT_WAIT, CACHE_REQUESTS]
+
+# [query count, query seconds] for the request being served in this context, if any.
+_request_db_stats = ContextVar("request_db_stats", default=None)
+
+def get_request_db_stats():
+    """[query count, query seconds] so far for the request being served, or None outside MetricsMiddleware"""
+    return _request_db_stats.get()
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+def timed_pool_class(pool_class):
+    """Subclass a SQLAlchemy pool so every checkout records how long it waited for a connection"""
+
+    class TimedPool(pool_class):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+    TimedPool.__name__ = TimedPool.__qualname__ = f"Timed{pool_class.__name__}"
+    return TimedPool
+
+def instrument_engine(engine):
+    """Count and time every statement the engine executes, attributing them to the current request"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_QUERIES.inc()
+        DB_QUERY_DURATION.observe(elapsed)
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and SQL usage per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        stats = [0, 0.0]
+        token = _request_db_stats.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_db_stats.reset(token)
+            route = scope.get("route")
+            # Unmatched paths are collapsed so random URLs can't blow up the label set.
+            route_path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, scope["method"], route_path, str(status))
+            HTTP_REQUEST_DB_QUERIES.observe(stats[0], route_path)
+            HTTP_REQUEST_DB_SECONDS.observe(stats[1], route_path)
+
+def render_metrics(gauges: dict = None) -> str:
+    """Prometheus text exposition of all metrics plus point-in-time gauges {name: (help, value)}"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, (documentation, value) in (gauges or {}).items():
+        if value is None:
+            continue
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import random
+import itertools
+import threading
+import logging
+from collections import Counter, deque
+from datetime import timedelta
+from database import get_current_time_ist
+from metrics_service import get_request_db_stats
+
+logger = logging.getLogger(__name__)
+
+# Requests sending `X-Profile: <PROFILE_TOKEN>` are profiled; the same token guards /admin/profiles.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Requests slower than this are kept; setting it keeps the sampler running whenever requests are in flight.
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "100"))
+PROFILE_HEADER = b"x-profile"
+
+# Innermost library frame decides where a sample's time went.
+REDIS_PATHS = (f"{os.sep}redis{os.sep}",)
+DB_PATHS = (f"{os.sep}sqlalchemy{os.sep}", f"{os.sep}pymysql{os.sep}", f"{os.sep}aiomysql{os.sep}",
+            f"{os.sep}sqlite3{os.sep}", f"{os.sep}aiosqlite{os.sep}")
+
+def format_frame(code) -> str:
+    path = code.co_filename.split(os.sep)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+def classify_stack(codes: list) -> str:
+    for code in codes:
+        if any(marker in code.co_filename for marker in REDIS_PATHS):
+            return "redis"
+        if any(marker in code.co_filename for marker in DB_PATHS):
+            return "db"
+    return "python"
+
+class RequestProfile:
+    """Stack samples and time per category collected for one request"""
+
+    def __init__(self, profile_id: int, trigger: str):
+        self.profile_id = profile_id
+        self.trigger = trigger
+        self.stacks = Counter()
+        self.seconds = Counter()
+
+    def record(self, codes: list, elapsed: float):
+        """Add one sample; `codes` runs from the innermost frame out to the request's root"""
+        self.stacks[";".join(format_frame(code) for code in reversed(codes))] += 1
+        self.seconds[classify_stack(codes)] += elapsed
+
+class StackSampler:
+    """Background thread sampling every thread's stack while profiled requests are in flight
+
+    A sample is attributed to a request when the request's middleware frame is on the stack, so
+    concurrent requests on one event loop don't mix; work handed to other threads or tasks shows up
+    as waiting time instead.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+
+    def register(self, root_frame, profile: RequestProfile):
+        with self.lock:
+            self.active[id(root_frame)] = (root_frame, profile)
+            self.wakeup.set()
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self.worker.start()
+
+    def unregister(self, root_frame):
+        with self.lock:
+            self.active.pop(id(root_frame), None)
+
+    def _run(self):
+        own_thread = threading.get_ident()
+        last_sample = time.perf_counter()
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            elapsed, last_sample = min(now - last_sample, self.interval * 2), now
+            # Sampling under the lock means a request never reads its profile mid-update.
+            with self.lock:
+                if not self.active:
+                    self.wakeup.clear()
+                    continue
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        self._sample(frame, elapsed)
+
+    def _sample(self, frame, elapsed: float):
+        codes = []
+        while frame is not None:
+            entry = self.active.get(id(frame))
+            if entry is not None and entry[0] is frame:
+                entry[1].record(codes, elapsed)
+                return
+            codes.append(frame.f_code)
+            frame = frame.f_back
+
+class RequestProfiler:
+    """Decides which requests to profile and keeps the most recent profiles in a ring buffer"""
+
+    def __init__(self, token: str = PROFILE_TOKEN, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 slow_ms: float = PROFILE_SLOW_MS, interval_ms: float = PROFILE_INTERVAL_MS,
+                 buffer_size: int = PROFILE_BUFFER_SIZE):
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.sampler = StackSampler(interval_ms / 1000)
+        self.profiles = deque(maxlen=buffer_size)
+        self.ids = itertools.count(1)
+        self.captured = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token or self.sample_rate > 0 or self.slow_ms > 0)
+
+    def choose_trigger(self, scope):
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER and value == self.token:
+                    return "header"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        if self.slow_ms > 0:
+            return "slow"
+        return None
+
+    def store(self, profile: RequestProfile, scope, status: int, duration: float, db_stats):
+        sampled = sum(profile.seconds.values())
+        route = scope.get("route")
+        self.profiles.append({
+            "id": profile.profile_id,
+            "trigger": profile.trigger,
+            "method": scope["method"],
+            "path": scope["path"],
+            "route": route.path if route is not None else None,
+            "status": status,
+            "started_at": (get_current_time_ist() - timedelta(seconds=duration)).isoformat(),
+            "duration_ms": round(duration * 1000, 2),
+            "breakdown_ms": {
+                "db": round(profile.seconds["db"] * 1000, 2),
+                "redis": round(profile.seconds["redis"] * 1000, 2),
+                "python": round(profile.seconds["python"] * 1000, 2),
+                # Suspended at an await: non-blocking IO, the threadpool or other requests on the loop.
+                "waiting": round(max(duration - sampled, 0) * 1000, 2),
+            },
+            "db_queries": db_stats[0] if db_stats else None,
+            "db_query_ms": round(db_stats[1] * 1000, 2) if db_stats else None,
+            "samples": sum(profile.stacks.values()),
+            "stacks": dict(profile.stacks),
+        })
+        self.captured += 1
+
+    def list_profiles(self) -> list:
+        """Newest first, without the stacks"""
+        return [{key: value for key, value in profile.items() if key != "stacks"} for profile in reversed(self.profiles)]
+
+    def get_profile(self, profile_id: int):
+        for profile in self.profiles:
+            if profile["id"] == profile_id:
+                return profile
+        return None
+
+def render_folded_stacks(profile: dict) -> str:
+    """Brendan Gregg's folded format, read by flamegraph.pl, inferno and speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(profile["stacks"].items()))
+
+class ProfilingMiddleware:
+    """ASGI middleware capturing stack-sampled profiles of selected requests"""
+
+    def __init__(self, app, profiler: RequestProfiler = None):
+        self.app = app
+        self.profiler = profiler or request_profiler
+
+    async def __call__(self, scope, receive, send):
+        trigger = self.profiler.choose_trigger(scope) if scope["type"] == "http" else None
+        if trigger is None:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(next(self.profiler.ids), trigger)
+        status = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if trigger == "header":
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-profile-id", str(profile.profile_id).encode())
+                    ]
+            await send(message)
+
+        root_frame = sys._getframe()
+        started = time.perf_counter()
+        self.profiler.sampler.register(root_frame, profile)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            self.profiler.sampler.unregister(root_frame)
+            duration = time.perf_counter() - started
+            if trigger != "slow" or duration * 1000 >= self.profiler.slow_ms:
+                self.profiler.store(profile, scope, status, duration, get_request_db_stats())
+
+request_profiler = RequestProfiler()
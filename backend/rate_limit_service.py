@@ -0,0 +1,155 @@
+import os
+import math
+import time
+import logging
+import ipaddress
+from dataclasses import dataclass
+from fastapi import HTTPException, Request
+from cache_service import redis_client, async_redis_client, LocalTTLCache
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Addresses or networks of the proxies (nginx) whose X-Real-IP is believed. Anyone else could pick
+# their own key with the header, so by default it is ignored.
+RATE_LIMIT_TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+RATE_LIMIT_LOCAL_SIZE = int(os.getenv("RATE_LIMIT_LOCAL_SIZE", "10000"))
+# Tokens a worker takes from Redis at once, spending the rest locally for up to RATE_LIMIT_LEASE_SECONDS.
+RATE_LIMIT_LEASE_SIZE = int(os.getenv("RATE_LIMIT_LEASE_SIZE", "10"))
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "1.0"))
+
+# Refills the bucket for the time since its last update, then grants up to ARGV[3] whole tokens.
+# Returns {granted, seconds until one token is available} - as strings, since Lua numbers become integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+local retry_after = 0
+if granted == 0 then
+    retry_after = (1 - tokens) / rate
+end
+return {tostring(granted), tostring(retry_after)}
+"""
+
+@dataclass(frozen=True)
+class RateLimitRule:
+    name: str
+    requests: int
+    per_seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.per_seconds
+
+    @property
+    def lease_size(self) -> int:
+        # Small limits are never leased out in batches, so one worker can't sit on most of a user's budget.
+        return max(1, min(RATE_LIMIT_LEASE_SIZE, self.requests // 10))
+
+def parse_rate_limit(name: str, default: str) -> RateLimitRule:
+    """Read RATE_LIMIT_<NAME> as '<requests>/<seconds>'"""
+    requests, per_seconds = os.getenv(f"RATE_LIMIT_{name.upper()}", default).split("/")
+    return RateLimitRule(name, int(requests), float(per_seconds))
+
+RATE_LIMIT_RULES = {
+    rule.name: rule for rule in (
+        parse_rate_limit("shorten", "60/60"),
+        parse_rate_limit("shorten_batch", "10/60"),
+        parse_rate_limit("check_url", "60/60"),
+        parse_rate_limit("redirect", "600/60"),
+    )
+}
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in RATE_LIMIT_TRUSTED_PROXIES)
+
+def get_rate_limit_identity(request: Request) -> str:
+    """The logged-in user, otherwise the client address - as reported by nginx when the peer is a trusted proxy"""
+    user_id = request.session.get("user_id")
+    if user_id:
+        return f"user:{user_id}"
+    peer = request.client.host if request.client else None
+    client_ip = request.headers.get("x-real-ip") if peer and is_trusted_proxy(peer) else None
+    return f"ip:{client_ip or peer or 'unknown'}"
+
+class RateLimiter:
+    """Token buckets in Redis, shared by all workers, with a per-worker lease and denial cache in front
+
+    Each worker takes a few tokens per Redis round trip and spends them locally, and remembers
+    denied keys until their Retry-After, so most requests (and all of a flood) never reach Redis.
+    """
+
+    def __init__(self, enabled: bool = RATE_LIMIT_ENABLED):
+        self.enabled = enabled
+        self.leases = LocalTTLCache(RATE_LIMIT_LOCAL_SIZE, RATE_LIMIT_LEASE_SECONDS)
+        self.denied = LocalTTLCache(RATE_LIMIT_LOCAL_SIZE, 1.0)
+        self.script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.async_script = async_redis_client.register_script(TOKEN_BUCKET_SCRIPT) if async_redis_client else None
+
+    async def check(self, rule: RateLimitRule, identity: str):
+        """Spend one token for identity under rule, raising 429 with Retry-After when none are left"""
+        if not self.enabled:
+            return
+        key = f"rate_limit:{rule.name}:{identity}"
+
+        denied_until = self.denied.get(key)
+        if denied_until is not None:
+            raise self._too_many_requests(denied_until - time.monotonic())
+
+        lease = self.leases.get(key)
+        if lease is not None and lease[0] > 0:
+            lease[0] -= 1
+            return
+
+        try:
+            granted, retry_after = await self._take_tokens(key, rule, rule.lease_size)
+        except Exception as redis_error:
+            # Fail open: a Redis outage shouldn't take the API down with it.
+            logger.warning(f"Rate limit check failed for {key}: {redis_error}")
+            return
+
+        if granted == 0:
+            self.denied.set(key, time.monotonic() + retry_after, retry_after)
+            raise self._too_many_requests(retry_after)
+        if granted > 1:
+            self.leases.set(key, [granted - 1])
+
+    async def _take_tokens(self, key: str, rule: RateLimitRule, requested: int) -> tuple:
+        args = [rule.rate, rule.requests, requested, time.time()]
+        if self.async_script is not None:
+            granted, retry_after = await self.async_script(keys=[key], args=args)
+        else:
+            granted, retry_after = self.script(keys=[key], args=args)
+        return int(granted), float(retry_after)
+
+    @staticmethod
+    def _too_many_requests(retry_after: float) -> HTTPException:
+        return HTTPException(status_code=429, detail="Too many requests, please slow down",
+                             headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+rate_limiter = RateLimiter()
+
+def rate_limited(rule_name: str):
+    """Route dependency enforcing one of RATE_LIMIT_RULES for the caller"""
+    rule = RATE_LIMIT_RULES[rule_name]
+
+    async def check_rate_limit(request: Request):
+        await rate_limiter.check(rule, get_rate_limit_identity(request))
+
+    return check_rate_limit
@@ -0,0 +1,189 @@
+import os
+import time
+import threading
+import logging
+from collections import Counter
+from datetime import timedelta
+import redis
+from sqlalchemy import delete, update
+from database import (SessionLocal, URL, Analytics, AnalyticsRollup, AnalyticsRollupBreakdown, RollupState,
+                      get_current_time_ist)
+from cache_service import invalidate_redirect, invalidate_user_caches, RedisLock
+from rollup_service import ROLLUP_STATE_NAME
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "300"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "500"))
+REAPER_BATCH_PAUSE = float(os.getenv("REAPER_BATCH_PAUSE", "0.5"))
+REAPER_MAX_BATCHES = int(os.getenv("REAPER_MAX_BATCHES", "200"))
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "0"))
+ANALYTICS_RETENTION_REQUIRE_ROLLUP = os.getenv("ANALYTICS_RETENTION_REQUIRE_ROLLUP", "true").lower() == "true"
+REAPER_LOCK_KEY = "reaper:lock"
+
+class LifecycleReaper:
+    """Deactivates expired links, purges soft-deleted ones and trims old analytics in small, paced batches"""
+
+    def __init__(self, interval=REAPER_INTERVAL, batch_size=REAPER_BATCH_SIZE, batch_pause=REAPER_BATCH_PAUSE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.stopped = threading.Event()
+        self.worker = None
+        self.stats = Counter()
+        self.last_run_seconds = None
+        self.lock = RedisLock(REAPER_LOCK_KEY, int(interval) + 60, client=redis_client)
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="lifecycle-reaper", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker = None
+
+    def get_stats(self) -> dict:
+        return {
+            "runs": self.stats["runs"],
+            "expired_urls": self.stats["expired_urls"],
+            "purged_urls": self.stats["purged_urls"],
+            "deleted_analytics": self.stats["deleted_analytics"],
+            "failures": self.stats["failures"],
+            "last_run_seconds": self.last_run_seconds,
+        }
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """One full reaping pass, skipped if another worker holds the lock"""
+        if not self.lock.acquire():
+            return
+        started = time.monotonic()
+        try:
+            self._repeat(self.deactivate_expired_batch)
+            self._repeat(self.purge_deleted_batch)
+            if ANALYTICS_RETENTION_DAYS > 0:
+                self._repeat(self.trim_analytics_batch)
+            self.stats["runs"] += 1
+        except Exception as e:
+            self.stats["failures"] += 1
+            logger.error(f"Lifecycle reaper failed: {e}")
+        finally:
+            self.last_run_seconds = round(time.monotonic() - started, 3)
+            self.lock.release()
+
+    def _repeat(self, batch_step):
+        # Pause between batches so the deletes never swamp replication.
+        for _ in range(REAPER_MAX_BATCHES):
+            if self.stopped.is_set() or batch_step() < self.batch_size:
+                return
+            self._pause()
+
+    def _pause(self):
+        time.sleep(self.batch_pause)
+        # Renewing between batches keeps a long pass from outliving the lock and overlapping another worker's.
+        if not self.lock.renew():
+            raise RuntimeError("Reaper lock expired mid-pass")
+
+    def deactivate_expired_batch(self) -> int:
+        now = get_current_time_ist()
+        db = SessionLocal()
+        try:
+            expired = db.query(URL.id, URL.short_code, URL.user_id).filter(
+                URL.is_active == True,
+                URL.expires_at < now
+            ).limit(self.batch_size).all()
+            if not expired:
+                return 0
+
+            # Only is_active changes: expired links keep answering 410 and are never purged like deleted ones.
+            db.execute(
+                update(URL)
+                .where(URL.id.in_([row.id for row in expired]))
+                .values(is_active=False),
+                execution_options={"synchronize_session": False}
+            )
+            db.commit()
+        finally:
+            db.close()
+
+        for row in expired:
+            try:
+                invalidate_redirect(row.short_code)
+            except Exception as cache_error:
+                logger.warning(f"Failed to evict expired {row.short_code}: {cache_error}")
+        invalidate_user_caches(user_ids=[row.user_id for row in expired])
+        self.stats["expired_urls"] += len(expired)
+        return len(expired)
+
+    def purge_deleted_batch(self) -> int:
+        db = SessionLocal()
+        try:
+            purgeable = db.query(URL.id, URL.short_code).filter(
+                URL.is_active == False,
+                URL.backup_until < get_current_time_ist()
+            ).limit(self.batch_size).all()
+            if not purgeable:
+                return 0
+
+            short_codes = [row.short_code for row in purgeable]
+            deleted_analytics = self._delete_analytics_for_codes(db, short_codes)
+            db.execute(delete(AnalyticsRollup).where(AnalyticsRollup.short_code.in_(short_codes)),
+                       execution_options={"synchronize_session": False})
+            db.execute(delete(AnalyticsRollupBreakdown).where(AnalyticsRollupBreakdown.short_code.in_(short_codes)),
+                       execution_options={"synchronize_session": False})
+            db.execute(delete(URL).where(URL.id.in_([row.id for row in purgeable])),
+                       execution_options={"synchronize_session": False})
+            db.commit()
+        finally:
+            db.close()
+
+        self.stats["purged_urls"] += len(purgeable)
+        self.stats["deleted_analytics"] += deleted_analytics
+        return len(purgeable)
+
+    def _delete_analytics_for_codes(self, db, short_codes: list) -> int:
+        deleted = 0
+        while True:
+            ids = [row.id for row in db.query(Analytics.id).filter(
+                Analytics.short_code.in_(short_codes)
+            ).limit(self.batch_size)]
+            if not ids:
+                return deleted
+            db.execute(delete(Analytics).where(Analytics.id.in_(ids)), execution_options={"synchronize_session": False})
+            db.commit()
+            deleted += len(ids)
+            if len(ids) < self.batch_size:
+                return deleted
+            self._pause()
+
+    def trim_analytics_batch(self) -> int:
+        cutoff = get_current_time_ist() - timedelta(days=ANALYTICS_RETENTION_DAYS)
+        db = SessionLocal()
+        try:
+            query = db.query(Analytics.id).filter(Analytics.clicked_at < cutoff)
+            if ANALYTICS_RETENTION_REQUIRE_ROLLUP:
+                # Only drop raw clicks the rollup worker has already folded into the daily aggregates.
+                state = db.query(RollupState).filter(RollupState.name == ROLLUP_STATE_NAME).first()
+                query = query.filter(Analytics.id <= (state.last_analytics_id if state else 0))
+            ids = [row.id for row in query.order_by(Analytics.id).limit(self.batch_size)]
+            if not ids:
+                return 0
+
+            db.execute(delete(Analytics).where(Analytics.id.in_(ids)), execution_options={"synchronize_session": False})
+            db.commit()
+        finally:
+            db.close()
+
+        self.stats["deleted_analytics"] += len(ids)
+        return len(ids)
+
+lifecycle_reaper = LifecycleReaper()
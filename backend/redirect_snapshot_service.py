@@ -0,0 +1,262 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+import logging
+from array import array
+from collections import Counter
+from datetime import datetime
+from database import SessionLocal, URL, get_current_time_ist
+
+logger = logging.getLogger(__name__)
+
+REDIRECT_SNAPSHOT_ENABLED = os.getenv("REDIRECT_SNAPSHOT_ENABLED", "false").lower() == "true"
+REDIRECT_SNAPSHOT_PATH = os.getenv("REDIRECT_SNAPSHOT_PATH",
+                                   os.path.join(tempfile.gettempdir(), "url-shortener-redirects.snapshot"))
+REDIRECT_SNAPSHOT_INTERVAL = int(os.getenv("REDIRECT_SNAPSHOT_INTERVAL", "300"))
+REDIRECT_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("REDIRECT_SNAPSHOT_CHECK_INTERVAL", "5"))
+# Invalidations received this long before a snapshot was started are kept, covering late pub/sub delivery.
+REDIRECT_SNAPSHOT_INVALIDATION_SLACK = float(os.getenv("REDIRECT_SNAPSHOT_INVALIDATION_SLACK", "10"))
+SCAN_FETCH_SIZE = 10000
+
+# File layout: header | records | slot table. Each record is RECORD (expires_at, url length, code length)
+# followed by the code and URL bytes; each slot is (64-bit code hash, record offset + 1), 0 meaning empty.
+MAGIC = b"URLSNAP1"
+HEADER = struct.Struct("<8sdQQQ")  # magic, built_at, entry count, slot count, slot table offset
+RECORD = struct.Struct("<qIB")
+SLOT = struct.Struct("<QQ")
+NO_EXPIRY = 0
+EPOCH = datetime(1970, 1, 1)
+
+def hash_short_code(short_code: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(short_code, digest_size=8).digest(), "little")
+
+def to_epoch_seconds(moment: datetime) -> int:
+    return int((moment - EPOCH).total_seconds())
+
+def build_snapshot_file(path: str) -> int:
+    """Write every active, unexpired URL to a hash table file and atomically replace `path` with it"""
+    built_at = time.time()
+    now = get_current_time_ist()
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    hashes = array("Q")
+    offsets = array("Q")
+
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".redirect-snapshot-")
+    try:
+        with os.fdopen(handle, "wb") as snapshot_file:
+            snapshot_file.write(b"\0" * HEADER.size)
+            offset = HEADER.size
+            db = SessionLocal()
+            try:
+                result = db.execute(
+                    URL.__table__.select().with_only_columns(URL.short_code, URL.original_url, URL.expires_at)
+                    .where(URL.is_active == True).where((URL.expires_at == None) | (URL.expires_at > now)),
+                    execution_options={"stream_results": True, "yield_per": SCAN_FETCH_SIZE}
+                )
+                for rows in result.partitions():
+                    chunk = []
+                    for row in rows:
+                        code = row.short_code.encode()
+                        original_url = row.original_url.encode()
+                        expires_at = to_epoch_seconds(row.expires_at) if row.expires_at else NO_EXPIRY
+                        chunk.append(RECORD.pack(expires_at, len(original_url), len(code)) + code + original_url)
+                        hashes.append(hash_short_code(code))
+                        offsets.append(offset)
+                        offset += len(chunk[-1])
+                    snapshot_file.write(b"".join(chunk))
+            finally:
+                db.close()
+
+            # Power-of-two slot count at most half full, so linear probing stays short.
+            slot_count = 1 << max(4, (len(hashes) * 2 - 1).bit_length())
+            mask = slot_count - 1
+            slots = array("Q", bytes(slot_count * SLOT.size))
+            for code_hash, record_offset in zip(hashes, offsets):
+                index = code_hash & mask
+                while slots[index * 2 + 1]:
+                    index = (index + 1) & mask
+                slots[index * 2] = code_hash
+                slots[index * 2 + 1] = record_offset + 1
+            snapshot_file.write(slots.tobytes())
+
+            snapshot_file.seek(0)
+            snapshot_file.write(HEADER.pack(MAGIC, built_at, len(hashes), slot_count, offset))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return len(hashes)
+
+class RedirectSnapshot:
+    """Read-only view of one snapshot file; lookups read straight from the shared mapping"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            self.identity = self._identity(os.fstat(snapshot_file.fileno()))
+            self.data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.built_at, self.count, self.slot_count, self.slots_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a redirect snapshot")
+        self.mask = self.slot_count - 1
+
+    @staticmethod
+    def _identity(stat_result) -> tuple:
+        return stat_result.st_ino, stat_result.st_mtime_ns
+
+    def get(self, short_code: str):
+        """(original_url, expires_at epoch seconds or 0) for a code, or None if it isn't in the snapshot"""
+        code = short_code.encode()
+        code_hash = hash_short_code(code)
+        data = self.data
+        index = code_hash & self.mask
+        while True:
+            slot_hash, record_offset = SLOT.unpack_from(data, self.slots_offset + index * SLOT.size)
+            if not record_offset:
+                return None
+            if slot_hash == code_hash:
+                expires_at, url_length, code_length = RECORD.unpack_from(data, record_offset - 1)
+                start = record_offset - 1 + RECORD.size
+                if data[start:start + code_length] == code:
+                    start += code_length
+                    return data[start:start + url_length].decode("utf-8"), expires_at
+            index = (index + 1) & self.mask
+
+class RedirectSnapshotManager:
+    """Keeps this worker on the newest redirect snapshot file, rebuilding it when it is due
+
+    One worker per host (guarded by a file lock) rebuilds the file every REDIRECT_SNAPSHOT_INTERVAL
+    seconds and swaps it in with a rename; every worker maps it read-only, so they share one
+    page-cache copy. Codes invalidated after the snapshot was taken (deleted or re-created) are
+    skipped so they fall through to Redis and MySQL, and if invalidations may have been missed the
+    snapshot is ignored until a newer one is built.
+    """
+
+    def __init__(self, path: str = REDIRECT_SNAPSHOT_PATH, enabled: bool = REDIRECT_SNAPSHOT_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self.snapshot = None
+        self.invalidated = {}
+        self.invalid_before = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.worker = None
+        self.stats = Counter()
+
+    def start(self):
+        if not self.enabled or (self.worker and self.worker.is_alive()):
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="redirect-snapshot", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker = None
+
+    def lookup(self, short_code: str):
+        """(original_url, expires_at epoch seconds or 0) from the snapshot, or None to fall back"""
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.built_at < self.invalid_before or short_code in self.invalidated:
+            return None
+        entry = snapshot.get(short_code)
+        self.stats["hits" if entry else "misses"] += 1
+        return entry
+
+    def invalidate(self, short_code: str):
+        """Stop answering for a code whose row changed after the current snapshot was taken"""
+        if self.enabled:
+            with self.lock:
+                self.invalidated[short_code] = time.time()
+
+    def invalidate_many(self, invalidated: dict):
+        """Skip codes invalidated at the given times (epoch seconds), e.g. read back from the shared log"""
+        if self.enabled and invalidated:
+            with self.lock:
+                for short_code, invalidated_at in invalidated.items():
+                    self.invalidated[short_code] = max(invalidated_at, self.invalidated.get(short_code, 0))
+
+    def invalidate_all(self):
+        """Ignore every snapshot built before now, e.g. after invalidation messages may have been lost"""
+        if self.enabled:
+            self.invalid_before = time.time()
+
+    def get_stats(self) -> dict:
+        snapshot = self.snapshot
+        return {
+            "loaded": snapshot is not None,
+            "entries": snapshot.count if snapshot else 0,
+            "bytes": len(snapshot.data) if snapshot else 0,
+            "age_seconds": round(time.time() - snapshot.built_at, 1) if snapshot else None,
+            "invalidated": len(self.invalidated),
+            "hits": self.stats["hits"],
+            "misses": self.stats["misses"],
+            "rebuilds": self.stats["rebuilds"],
+        }
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self._rebuild_if_due()
+                self._load_if_changed()
+            except Exception as e:
+                logger.warning(f"Redirect snapshot error: {e}")
+            self.stopped.wait(REDIRECT_SNAPSHOT_CHECK_INTERVAL)
+
+    def _read_built_at(self):
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                magic, built_at, *_ = HEADER.unpack(snapshot_file.read(HEADER.size))
+            return built_at if magic == MAGIC else None
+        except (OSError, struct.error):
+            return None
+
+    def _is_due(self) -> bool:
+        built_at = self._read_built_at()
+        return built_at is None or built_at < self.invalid_before or time.time() - built_at >= REDIRECT_SNAPSHOT_INTERVAL
+
+    def _rebuild_if_due(self):
+        if not self._is_due():
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker on this host is rebuilding
+            try:
+                # The previous holder may have just finished a rebuild.
+                if self._is_due():
+                    started = time.perf_counter()
+                    count = build_snapshot_file(self.path)
+                    self.stats["rebuilds"] += 1
+                    logger.info(f"Built redirect snapshot: {count} codes in {time.perf_counter() - started:.1f}s")
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_if_changed(self):
+        try:
+            identity = RedirectSnapshot._identity(os.stat(self.path))
+        except FileNotFoundError:
+            return
+        if self.snapshot is not None and self.snapshot.identity == identity:
+            return
+
+        snapshot = RedirectSnapshot(self.path)
+        cutoff = snapshot.built_at - REDIRECT_SNAPSHOT_INVALIDATION_SLACK
+        with self.lock:
+            self.invalidated = {code: at for code, at in self.invalidated.items() if at >= cutoff}
+            # The old mapping is not closed explicitly: a lookup may still be reading it, and it is
+            # unmapped once the last reference goes away.
+            self.snapshot = snapshot
+
+redirect_snapshot = RedirectSnapshotManager()
@@ -0,0 +1,241 @@
+import os
+import re
+import time
+import threading
+import logging
+from collections import Counter
+from urllib.parse import urlparse
+import redis
+from sqlalchemy import func
+from database import SessionLocal, Analytics, AnalyticsRollup, AnalyticsRollupBreakdown, RollupState
+from intern_service import join_click_strings, CLICK_USER_AGENT, CLICK_REFERER
+from cache_service import RedisLock
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+redis_client = redis.from_url(REDIS_URL)
+
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "30"))
+ROLLUP_BATCH_SIZE = int(os.getenv("ROLLUP_BATCH_SIZE", "5000"))
+# How long a missing analytics id holds the watermark before it is taken for a rolled-back insert.
+# Must exceed the longest click insert transaction, or a row committing after it is never rolled up.
+ROLLUP_GAP_TIMEOUT = float(os.getenv("ROLLUP_GAP_TIMEOUT", "300"))
+ROLLUP_LOCK_KEY = "analytics_rollup:lock"
+ROLLUP_STATE_NAME = "analytics"
+
+BUCKETS = ("hour", "day")
+MAX_SERIES_BUCKETS = {"hour": 24 * 92, "day": 3660}
+BREAKDOWN_LIMIT = 10
+
+_USER_AGENT_FAMILIES = [
+    ("Bot", re.compile(r"bot|crawl|spider|slurp|preview", re.IGNORECASE)),
+    ("Edge", re.compile(r"Edg(e|A|iOS)?/")),
+    ("Opera", re.compile(r"OPR/|Opera")),
+    ("Samsung Internet", re.compile(r"SamsungBrowser/")),
+    ("Chrome", re.compile(r"Chrome/|CriOS/")),
+    ("Firefox", re.compile(r"Firefox/|FxiOS/")),
+    ("Safari", re.compile(r"Safari/")),
+    ("curl", re.compile(r"^curl/")),
+]
+
+def get_user_agent_family(user_agent: str) -> str:
+    """Coarse browser family for a user-agent string"""
+    if not user_agent:
+        return "Unknown"
+    for family, pattern in _USER_AGENT_FAMILIES:
+        if pattern.search(user_agent):
+            return family
+    return "Other"
+
+def get_referer_host(referer: str) -> str:
+    if not referer:
+        return "Direct"
+    host = urlparse(referer).hostname
+    return host[:255] if host else "Unknown"
+
+def get_bucket_start(timestamp, bucket: str):
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if bucket == "day":
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+def upsert_click_increments(db, model, rows: list):
+    """INSERT rows or add their clicks to the existing row with the same primary key"""
+    if not rows:
+        return
+    table = model.__table__
+    if db.get_bind().dialect.name == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        statement = statement.on_duplicate_key_update(clicks=table.c.clicks + statement.inserted.clicks)
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[column.name for column in table.primary_key.columns],
+            set_={"clicks": table.c.clicks + statement.excluded.clicks}
+        )
+    db.execute(statement, rows)
+
+def aggregate_clicks(clicks) -> tuple:
+    """Fold raw analytics rows into rollup and breakdown increments"""
+    totals = Counter()
+    breakdowns = Counter()
+    for click in clicks:
+        if click.clicked_at is None:
+            continue
+        referer_host = get_referer_host(click.referer)
+        user_agent_family = get_user_agent_family(click.user_agent)
+        for bucket in BUCKETS:
+            bucket_start = get_bucket_start(click.clicked_at, bucket)
+            totals[(click.short_code, bucket, bucket_start)] += 1
+            breakdowns[(click.short_code, bucket, bucket_start, "referer_host", referer_host)] += 1
+            breakdowns[(click.short_code, bucket, bucket_start, "ua_family", user_agent_family)] += 1
+
+    rollup_rows = [
+        {"short_code": code, "bucket": bucket, "bucket_start": start, "clicks": clicks}
+        for (code, bucket, start), clicks in totals.items()
+    ]
+    breakdown_rows = [
+        {"short_code": code, "bucket": bucket, "bucket_start": start, "dimension": dimension,
+         "value": value, "clicks": clicks}
+        for (code, bucket, start, dimension, value), clicks in breakdowns.items()
+    ]
+    return rollup_rows, breakdown_rows
+
+class IdGapTracker:
+    """Remembers when each missing analytics id was first seen by this worker"""
+
+    def __init__(self, timeout: float = ROLLUP_GAP_TIMEOUT):
+        self.timeout = timeout
+        self.first_seen = {}
+
+    def can_skip(self, missing_id: int) -> bool:
+        now = time.monotonic()
+        return now - self.first_seen.setdefault(missing_id, now) >= self.timeout
+
+    def forget_through(self, last_id: int):
+        self.first_seen = {missing_id: seen for missing_id, seen in self.first_seen.items() if missing_id > last_id}
+
+rollup_gaps = IdGapTracker()
+rollup_lock = RedisLock(ROLLUP_LOCK_KEY, max(int(ROLLUP_INTERVAL) * 2, 60), client=redis_client)
+
+def roll_up_new_clicks(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """Aggregate one batch of analytics rows past the watermark - returns the number processed"""
+    db = SessionLocal()
+    try:
+        # The row lock makes a worker that overlaps a stalled lock holder wait for its commit,
+        # rather than aggregating the same clicks from the same watermark.
+        state = db.query(RollupState).filter(RollupState.name == ROLLUP_STATE_NAME).with_for_update().first()
+        if not state:
+            state = RollupState(name=ROLLUP_STATE_NAME, last_analytics_id=0)
+            db.add(state)
+
+        clicks = join_click_strings(db.query(
+            Analytics.id, Analytics.short_code, CLICK_USER_AGENT, CLICK_REFERER, Analytics.clicked_at
+        )).filter(Analytics.id > state.last_analytics_id).order_by(Analytics.id).limit(batch_size).all()
+
+        # Ids are assigned at insert but become visible at commit, so a missing id may belong to a
+        # transaction still in flight: stop there until it shows up or ROLLUP_GAP_TIMEOUT passes.
+        settled = []
+        expected_id = state.last_analytics_id + 1
+        for click in clicks:
+            if click.id != expected_id and not rollup_gaps.can_skip(expected_id):
+                break
+            settled.append(click)
+            expected_id = click.id + 1
+
+        if not settled:
+            db.rollback()
+            return 0
+
+        rollup_rows, breakdown_rows = aggregate_clicks(settled)
+        upsert_click_increments(db, AnalyticsRollup, rollup_rows)
+        upsert_click_increments(db, AnalyticsRollupBreakdown, breakdown_rows)
+        state.last_analytics_id = settled[-1].id
+        db.commit()
+        rollup_gaps.forget_through(state.last_analytics_id)
+        return len(settled)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def run_rollup() -> int:
+    """Catch up on all committed clicks while holding the cross-worker rollup lock"""
+    if not rollup_lock.acquire():
+        return 0
+    try:
+        total = 0
+        while True:
+            processed = roll_up_new_clicks()
+            total += processed
+            if processed < ROLLUP_BATCH_SIZE:
+                return total
+            if not rollup_lock.renew():
+                logger.warning("Analytics rollup lock expired during catch-up, leaving the rest to its new holder")
+                return total
+    finally:
+        rollup_lock.release()
+
+def get_click_series(short_code: str, start, end, bucket: str = "day", db=None) -> dict:
+    """Click counts per bucket plus top referer hosts and browser families, read from the rollups"""
+    start = get_bucket_start(start, bucket)
+    rollups = db.query(AnalyticsRollup.bucket_start, AnalyticsRollup.clicks).filter(
+        AnalyticsRollup.short_code == short_code,
+        AnalyticsRollup.bucket == bucket,
+        AnalyticsRollup.bucket_start >= start,
+        AnalyticsRollup.bucket_start <= end
+    ).order_by(AnalyticsRollup.bucket_start).all()
+
+    def top_values(dimension):
+        total_clicks = func.sum(AnalyticsRollupBreakdown.clicks)
+        rows = db.query(AnalyticsRollupBreakdown.value, total_clicks).filter(
+            AnalyticsRollupBreakdown.short_code == short_code,
+            AnalyticsRollupBreakdown.bucket == bucket,
+            AnalyticsRollupBreakdown.bucket_start >= start,
+            AnalyticsRollupBreakdown.bucket_start <= end,
+            AnalyticsRollupBreakdown.dimension == dimension
+        ).group_by(AnalyticsRollupBreakdown.value).order_by(total_clicks.desc()).limit(BREAKDOWN_LIMIT).all()
+        return [{'value': value, 'clicks': int(clicks)} for value, clicks in rows]
+
+    return {
+        'short_code': short_code,
+        'bucket': bucket,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'total_clicks': sum(row.clicks for row in rollups),
+        'series': [{'bucket_start': row.bucket_start.isoformat(), 'clicks': row.clicks} for row in rollups],
+        'referer_hosts': top_values("referer_host"),
+        'user_agent_families': top_values("ua_family"),
+    }
+
+class AnalyticsRollupWorker:
+    """Background thread that keeps the rollup tables up to date"""
+
+    def __init__(self, interval=ROLLUP_INTERVAL):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.worker = None
+
+    def start(self):
+        if self.worker and self.worker.is_alive():
+            return
+        self.stopped.clear()
+        self.worker = threading.Thread(target=self._run, name="analytics-rollup", daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.worker = None
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                run_rollup()
+            except Exception as e:
+                logger.error(f"Analytics rollup failed: {e}")
+
+analytics_rollup_worker = AnalyticsRollupWorker()
@@ -0,0 +1,34 @@
+import os
+import sys
+import asyncio
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from link_check_service import LinkChecker
+
+def make_checker(handler) -> LinkChecker:
+    checker = LinkChecker()
+    checker.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return checker
+
+def test_bad_entry_is_reported_without_failing_the_batch():
+    checker = make_checker(lambda request: httpx.Response(200))
+    urls = ["https://example.com/ok", "https://example.com:99999/", "ftp://example.com/file", "not a url"]
+
+    results = asyncio.run(checker.check_many(urls))
+
+    assert results[0] == {"valid": True, "message": "URL is reachable"}
+    assert [result["valid"] for result in results[1:]] == [False, False, False]
+
+def test_unexpected_request_error_only_fails_its_entry():
+    def handler(request):
+        if request.url.host == "broken.example":
+            raise RuntimeError("boom")
+        return httpx.Response(404)
+    checker = make_checker(handler)
+
+    results = asyncio.run(checker.check_many(["https://broken.example/", "https://example.com/missing"]))
+
+    assert results[0]["message"] == "URL format is valid (reachability check failed)"
+    assert results[1] == {"valid": False, "message": "URL returned status 404"}
@@ -1,97 +1,272 @@
-import string
-import random
 import qrcode
-import base64
-import redis
+from qrcode.image.svg import SvgPathImage
 import os
+import base64
+import hashlib
 from io import BytesIO
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from datetime import datetime, timedelta
 from fastapi import HTTPException
+from sqlalchemy import or_, and_, insert
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from database import URL, Analytics, get_current_time_ist
+from code_service import code_allocator
+from intern_service import user_agent_interner, referer_interner, join_click_strings, CLICK_USER_AGENT, CLICK_REFERER
 import logging
 
 logger = logging.getLogger(__name__)
 
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_client = redis.from_url(REDIS_URL)
+MAX_CODE_ALLOCATION_ATTEMPTS = 5
+# Paths served by the app or nginx next to /{short_code}; a custom code can't take them.
+RESERVED_SHORT_CODES = {"api", "admin", "docs", "redoc", "health", "metrics", "static"}
+URL_CANONICALIZE = os.getenv("URL_CANONICALIZE", "false").lower() == "true"
+DEFAULT_PORTS = {"http": 80, "https": 443}
 
-def generate_random_short_code(length=6):
-    """Generate a random short code for URLs"""
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+def canonicalize_url(url: str) -> str:
+    """Equivalent form for dedup: lowercase scheme and host, no default port, sorted query parameters"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.username:
+        netloc = f"{parts.username}:{parts.password}@{netloc}" if parts.password else f"{parts.username}@{netloc}"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, parts.fragment))
 
-def create_qr_code_image(url: str) -> str:
-    """Generate QR code for URL and return as base64 string"""
-    try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_M,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url)
-        qr.make(fit=True)
+def get_url_fingerprint(url: str) -> bytes:
+    """16-byte MD5 digest used for indexed dedup - matches UNHEX(MD5(original_url)) when canonicalization is off"""
+    if URL_CANONICALIZE:
+        url = canonicalize_url(url)
+    return hashlib.md5(url.encode()).digest()
 
+def render_qr_code(url: str, image_format: str = "png") -> bytes:
+    """Render a QR code for URL as PNG or SVG bytes"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(url)
+    qr.make(fit=True)
+
+    if image_format == "svg":
+        qr_image = qr.make_image(image_factory=SvgPathImage)
+    else:
         qr_image = qr.make_image(fill_color="black", back_color="white")
-        
-        buffer = BytesIO()
-        qr_image.save(buffer, format='PNG')
-        img_base64 = base64.b64encode(buffer.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_base64}"
-    except Exception as e:
-        logger.error(f"Failed to generate QR code: {e}")
-        return None
+    
+    buffer = BytesIO()
+    qr_image.save(buffer)
+    return buffer.getvalue()
 
 def create_short_url(original_url: str, user_id: int, custom_code: str = None, 
                     expires_in_days: int = None, db: Session = None) -> URL:
     """Create a new short URL"""
     
-    existing_url = db.query(URL).filter(URL.original_url == original_url, URL.user_id == user_id).first()
-    if existing_url and existing_url.is_active:
+    url_hash = get_url_fingerprint(original_url)
+    existing_url = db.query(URL).filter(
+        URL.user_id == user_id,
+        URL.url_hash == url_hash,
+        URL.is_active == True
+    ).first()
+    if existing_url:
         return existing_url
     
     if custom_code:
+        if custom_code.lower() in RESERVED_SHORT_CODES:
+            raise HTTPException(status_code=400, detail=f"Short code '{custom_code}' is reserved")
         short_code = custom_code
         existing_code = db.query(URL).filter(URL.short_code == short_code, URL.is_active == True).first()
         if existing_code:
             raise HTTPException(status_code=400, detail=f"Short code '{custom_code}' is already taken")
     else:
-        short_code = generate_random_short_code()
-        while db.query(URL).filter(URL.short_code == short_code, URL.is_active == True).first():
-            short_code = generate_random_short_code()
+        short_code = code_allocator.allocate(db)
     
     expires_at = None
     if expires_in_days:
         expires_at = get_current_time_ist() + timedelta(days=expires_in_days)
     
-    short_url = f"http://localhost:8080/{short_code}"
-    qr_code_data = create_qr_code_image(short_url)
-    
     url_record = URL(
         original_url=original_url,
+        url_hash=url_hash,
         short_code=short_code,
         expires_at=expires_at,
-        qr_code=qr_code_data,
         user_id=user_id
     )
     
-    db.add(url_record)
-    db.commit()
+    # Allocated codes are never checked up front, so a clash with a custom code surfaces here instead.
+    for attempt in range(MAX_CODE_ALLOCATION_ATTEMPTS):
+        db.add(url_record)
+        try:
+            db.commit()
+            break
+        except IntegrityError:
+            db.rollback()
+            if custom_code:
+                raise HTTPException(status_code=400, detail=f"Short code '{custom_code}' is already taken")
+            # A generated code clashing is our problem, not the caller's: keep allocating, then give up with a 500.
+            if attempt == MAX_CODE_ALLOCATION_ATTEMPTS - 1:
+                logger.error(f"Could not allocate a free short code in {MAX_CODE_ALLOCATION_ATTEMPTS} attempts")
+                raise HTTPException(status_code=500, detail="Could not allocate a short code")
+            url_record.short_code = code_allocator.allocate(db)
+    
     db.refresh(url_record)
     
     return url_record
 
+def create_short_urls_batch(entries: list, user_id: int, db: Session = None) -> list:
+    """Create many short URLs with one dedup query and one multi-row insert
+    
+    entries are (original_url, custom_code, expires_in_days) tuples; returns one result dict per entry.
+    """
+    url_hashes = {original_url: get_url_fingerprint(original_url) for original_url, _, _ in entries}
+    existing_by_hash = dict(db.query(URL.url_hash, URL.short_code).filter(
+        URL.user_id == user_id,
+        URL.is_active == True,
+        URL.url_hash.in_(set(url_hashes.values()))
+    ).all())
+    existing_codes = {
+        original_url: existing_by_hash[url_hash]
+        for original_url, url_hash in url_hashes.items() if url_hash in existing_by_hash
+    }
+    
+    custom_codes = {custom_code for _, custom_code, _ in entries if custom_code}
+    taken_codes = set()
+    if custom_codes:
+        taken_codes = {code for (code,) in db.query(URL.short_code).filter(URL.short_code.in_(custom_codes))}
+    
+    now = get_current_time_ist()
+    results = []
+    new_rows = []
+    expiry_days = {}
+    for original_url, custom_code, expires_in_days in entries:
+        if original_url in existing_codes:
+            results.append({'original_url': original_url, 'short_code': existing_codes[original_url], 'status': 'existing'})
+            continue
+        
+        if custom_code and custom_code.lower() in RESERVED_SHORT_CODES:
+            results.append({'original_url': original_url, 'status': 'error',
+                            'detail': f"Short code '{custom_code}' is reserved"})
+            continue
+        
+        if custom_code and custom_code in taken_codes:
+            results.append({'original_url': original_url, 'status': 'error',
+                            'detail': f"Short code '{custom_code}' is already taken"})
+            continue
+        
+        short_code = custom_code or code_allocator.allocate(db)
+        taken_codes.add(short_code)
+        existing_codes[original_url] = short_code
+        expiry_days[original_url] = expires_in_days
+        new_rows.append({
+            'original_url': original_url,
+            'url_hash': url_hashes[original_url],
+            'short_code': short_code,
+            'created_at': now,
+            'expires_at': now + timedelta(days=expires_in_days) if expires_in_days else None,
+            'is_active': True,
+            'click_count': 0,
+            'user_id': user_id
+        })
+        results.append({'original_url': original_url, 'short_code': short_code, 'status': 'created'})
+    
+    if not new_rows:
+        return results
+    
+    try:
+        db.execute(insert(URL), new_rows)
+        db.commit()
+    except IntegrityError:
+        # Something raced us for a code; fall back to one insert per new row, which retries allocation.
+        db.rollback()
+        created = {}
+        for row in new_rows:
+            custom_code = row['short_code'] if row['short_code'] in custom_codes else None
+            try:
+                # The expiry goes in with the insert; a link deduplicated against one created meanwhile keeps its own.
+                url_record = create_short_url(row['original_url'], user_id, custom_code,
+                                              expiry_days[row['original_url']], db)
+                created[row['original_url']] = url_record.short_code
+            except HTTPException as e:
+                created[row['original_url']] = e
+        for result in results:
+            outcome = created.get(result['original_url'])
+            if isinstance(outcome, HTTPException):
+                result.pop('short_code', None)
+                result.update(status='error', detail=outcome.detail)
+            elif outcome:
+                result['short_code'] = outcome
+    
+    return results
+
+URL_LIST_COLUMNS = (URL.id, URL.original_url, URL.short_code, URL.created_at, URL.click_count)
+
 def get_user_urls(user_id: int, skip: int = 0, limit: int = 100, db: Session = None):
     """Get paginated list of user's URLs"""
-    urls = db.query(URL).filter(
+    urls = db.query(*URL_LIST_COLUMNS).filter(
         URL.user_id == user_id, 
         URL.is_active == True
-    ).order_by(URL.created_at.desc()).offset(skip).limit(limit).all()
+    ).order_by(URL.created_at.desc(), URL.id.desc()).offset(skip).limit(limit).all()
     
     return urls
 
+def encode_url_cursor(created_at: datetime, url_id: int) -> str:
+    """Opaque cursor pointing just past a (created_at, id) position"""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{url_id}".encode()).decode().rstrip("=")
+
+def decode_url_cursor(cursor: str):
+    try:
+        created_at, url_id = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        return datetime.fromisoformat(created_at), int(url_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def get_user_urls_page(user_id: int, cursor: str = None, limit: int = 100, db: Session = None):
+    """Keyset-paginated list of user's URLs - returns (urls, next_cursor)"""
+    query = db.query(*URL_LIST_COLUMNS).filter(URL.user_id == user_id, URL.is_active == True)
+    
+    if cursor:
+        created_at, url_id = decode_url_cursor(cursor)
+        query = query.filter(or_(
+            URL.created_at < created_at,
+            and_(URL.created_at == created_at, URL.id < url_id)
+        ))
+    
+    urls = query.order_by(URL.created_at.desc(), URL.id.desc()).limit(limit + 1).all()
+    
+    next_cursor = None
+    if len(urls) > limit:
+        urls = urls[:limit]
+        next_cursor = encode_url_cursor(urls[-1].created_at, urls[-1].id)
+    
+    return urls, next_cursor
+
+def get_user_url(short_code: str, user_id: int, db: Session = None):
+    """Get one of the user's URLs, including deleted ones"""
+    return db.query(URL).filter(URL.short_code == short_code, URL.user_id == user_id).first()
+
+def get_click_history(short_code: str, limit: int = 100, db: Session = None) -> list:
+    """Most recent clicks for a URL, newest first"""
+    analytics_records = join_click_strings(
+        db.query(Analytics.clicked_at, CLICK_USER_AGENT, CLICK_REFERER)
+    ).filter(
+        Analytics.short_code == short_code
+    ).order_by(Analytics.clicked_at.desc()).limit(limit).all()
+    
+    click_history = []
+    for record in analytics_records:
+        click_history.append({
+            'timestamp': record.clicked_at.isoformat() if record.clicked_at else None,
+            'date': record.clicked_at.strftime('%Y-%m-%d') if record.clicked_at else None,
+            'time': record.clicked_at.strftime('%H:%M:%S') if record.clicked_at else None,
+            'user_agent': record.user_agent or 'Unknown',
+            'referer': record.referer or 'Direct'
+        })
+    
+    return click_history
+
 def soft_delete_url(short_code: str, user_id: int, db: Session = None):
     """Soft delete URL with 2-day backup period"""
     url_record = db.query(URL).filter(
@@ -114,34 +289,30 @@ def soft_delete_url(short_code: str, user_id: int, db: Session = None):
     
     return backup_until
 
-def record_url_click(short_code: str, user_agent: str, referer: str, db: Session = None):
-    """Record analytics data for URL click"""
+def record_url_click(short_code: str, user_agent: str, referer: str, counted_in_redis: bool = False,
+                     db: Session = None):
+    """Record analytics data for URL click - returns the URL owner's id, or None if nothing was recorded
+
+    The Redis counter increment and cache invalidation are left to the caller, so in async IO mode
+    they run off the event loop instead of inside run_sync.
+    """
     try:
         url_record = db.query(URL).filter(URL.short_code == short_code).first()
         if url_record:
-            url_record.click_count += 1
+            if not counted_in_redis:
+                url_record.click_count += 1
             
             analytics_record = Analytics(
                 short_code=short_code,
-                user_agent=user_agent,
-                referer=referer,
+                user_agent_id=user_agent_interner.get_ids([user_agent], db).get(user_agent),
+                referer_id=referer_interner.get_ids([referer], db).get(referer),
                 clicked_at=get_current_time_ist()
             )
             db.add(analytics_record)
             db.commit()
             
-            try:
-                url_list_keys = redis_client.keys("urls_list:*")
-                if url_list_keys:
-                    redis_client.delete(*url_list_keys)
-                
-                analytics_key = f"analytics:{short_code}"
-                redis_client.delete(analytics_key)
-                
-                logger.info(f"Invalidated caches after click on {short_code}")
-            except Exception as cache_error:
-                logger.warning(f"Failed to invalidate cache: {cache_error}")
-            
-            logger.info(f"Recorded click for {short_code}")
+            logger.debug(f"Recorded click for {short_code}")
+            return url_record.user_id
     except Exception as e:
         logger.error(f"Failed to record click for {short_code}: {e}")
+    return None
@@ -0,0 +1,22 @@
+CREATE TABLE IF NOT EXISTS analytics_rollups (
+    short_code VARCHAR(10) NOT NULL,
+    bucket VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    clicks INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_code, bucket, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS analytics_rollup_breakdowns (
+    short_code VARCHAR(10) NOT NULL,
+    bucket VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    dimension VARCHAR(20) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    clicks INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_code, bucket, bucket_start, dimension, value)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name VARCHAR(50) PRIMARY KEY,
+    last_analytics_id BIGINT NOT NULL DEFAULT 0
+);
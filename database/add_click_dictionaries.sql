@@ -0,0 +1,30 @@
+-- Step 1 of 2: moves analytics.user_agent / referer strings into lookup tables, leaving integer ids behind.
+-- Apply before deploying the matching backend. The old columns stay, so backends still writing them
+-- keep working; once every backend writes ids, run drop_click_strings.sql to remove them.
+CREATE TABLE IF NOT EXISTS user_agents (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    value_hash BINARY(16) NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE KEY uq_user_agents_value_hash (value_hash)
+);
+
+CREATE TABLE IF NOT EXISTS referers (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    value_hash BINARY(16) NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE KEY uq_referers_value_hash (value_hash)
+);
+
+ALTER TABLE analytics
+    ADD COLUMN user_agent_id INT NULL AFTER short_code,
+    ADD COLUMN referer_id INT NULL AFTER user_agent_id;
+
+-- value_hash matches the application's UNHEX(MD5(value)) key; empty strings keep a NULL id.
+INSERT IGNORE INTO user_agents (value_hash, value)
+SELECT DISTINCT UNHEX(MD5(user_agent)), user_agent FROM analytics WHERE user_agent <> '';
+
+INSERT IGNORE INTO referers (value_hash, value)
+SELECT DISTINCT UNHEX(MD5(referer)), referer FROM analytics WHERE referer <> '';
+
+UPDATE analytics a JOIN user_agents u ON u.value_hash = UNHEX(MD5(a.user_agent)) SET a.user_agent_id = u.id;
+UPDATE analytics a JOIN referers r ON r.value_hash = UNHEX(MD5(a.referer)) SET a.referer_id = r.id;
@@ -0,0 +1,4 @@
+CREATE TABLE IF NOT EXISTS click_flushes (
+    shard INT PRIMARY KEY,
+    batch_id VARCHAR(32) NOT NULL DEFAULT ''
+);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS code_sequences (
+    name VARCHAR(50) PRIMARY KEY,
+    next_value BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO code_sequences (name, next_value)
+VALUES ('short_code', 0)
+ON DUPLICATE KEY UPDATE name=name;
@@ -0,0 +1,7 @@
+ALTER TABLE urls ADD COLUMN url_hash BINARY(16) NULL AFTER original_url;
+
+-- Matches the application's fingerprint while URL_CANONICALIZE is off.
+-- With canonicalization on, run `python backend/backfill_url_hashes.py` instead.
+UPDATE urls SET url_hash = UNHEX(MD5(original_url)) WHERE url_hash IS NULL;
+
+CREATE INDEX idx_urls_user_url_hash ON urls(user_id, url_hash);
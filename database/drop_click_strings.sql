@@ -0,0 +1,20 @@
+-- Step 2 of 2: run after every backend writes user_agent_id / referer_id (see add_click_dictionaries.sql).
+-- The ALTER rebuilds analytics, which is what returns the space held by the old TEXT columns,
+-- so run it during a quiet period.
+
+-- Clicks written by older backends after step 1 still carry only the strings.
+INSERT IGNORE INTO user_agents (value_hash, value)
+SELECT DISTINCT UNHEX(MD5(user_agent)), user_agent FROM analytics
+WHERE user_agent_id IS NULL AND user_agent <> '';
+
+INSERT IGNORE INTO referers (value_hash, value)
+SELECT DISTINCT UNHEX(MD5(referer)), referer FROM analytics
+WHERE referer_id IS NULL AND referer <> '';
+
+UPDATE analytics a JOIN user_agents u ON u.value_hash = UNHEX(MD5(a.user_agent))
+SET a.user_agent_id = u.id WHERE a.user_agent_id IS NULL;
+UPDATE analytics a JOIN referers r ON r.value_hash = UNHEX(MD5(a.referer))
+SET a.referer_id = r.id WHERE a.referer_id IS NULL;
+
+-- INPLACE forces the rebuild; MySQL 8.0.29+ would otherwise drop the columns INSTANTly and keep their space.
+ALTER TABLE analytics DROP COLUMN user_agent, DROP COLUMN referer, ALGORITHM=INPLACE;
@@ -0,0 +1,3 @@
+ALTER TABLE urls DROP COLUMN qr_code;
+
+OPTIMIZE TABLE urls;
@@ -11,6 +11,7 @@ CREATE TABLE IF NOT EXISTS users (
 CREATE TABLE IF NOT EXISTS urls (
     id INT AUTO_INCREMENT PRIMARY KEY,
     original_url TEXT NOT NULL,
+    url_hash BINARY(16) NULL,
     short_code VARCHAR(10) UNIQUE NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     expires_at TIMESTAMP NULL,
@@ -18,20 +19,68 @@ CREATE TABLE IF NOT EXISTS urls (
     click_count INT DEFAULT 0,
     deleted_at TIMESTAMP NULL,
     backup_until TIMESTAMP NULL,
-    qr_code LONGTEXT NULL,
     user_id INT NOT NULL,
     INDEX idx_short_code (short_code),
     INDEX idx_created_at (created_at),
     INDEX idx_user_id (user_id),
+    INDEX idx_urls_user_active_created (user_id, is_active, created_at, id),
+    INDEX idx_urls_user_url_hash (user_id, url_hash),
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
+CREATE TABLE IF NOT EXISTS user_agents (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    value_hash BINARY(16) NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE KEY uq_user_agents_value_hash (value_hash)
+);
+
+CREATE TABLE IF NOT EXISTS referers (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    value_hash BINARY(16) NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE KEY uq_referers_value_hash (value_hash)
+);
+
 CREATE TABLE IF NOT EXISTS analytics (
     id INT AUTO_INCREMENT PRIMARY KEY,
     short_code VARCHAR(10) NOT NULL,
-    user_agent TEXT,
-    referer TEXT,
+    user_agent_id INT NULL,
+    referer_id INT NULL,
     clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     INDEX idx_short_code (short_code),
     INDEX idx_clicked_at (clicked_at)
-);
\ No newline at end of file
+);
+
+CREATE TABLE IF NOT EXISTS code_sequences (
+    name VARCHAR(50) PRIMARY KEY,
+    next_value BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS click_flushes (
+    shard INT PRIMARY KEY,
+    batch_id VARCHAR(32) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS analytics_rollups (
+    short_code VARCHAR(10) NOT NULL,
+    bucket VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    clicks INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_code, bucket, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS analytics_rollup_breakdowns (
+    short_code VARCHAR(10) NOT NULL,
+    bucket VARCHAR(8) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    dimension VARCHAR(20) NOT NULL,
+    value VARCHAR(255) NOT NULL,
+    clicks INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_code, bucket, bucket_start, dimension, value)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name VARCHAR(50) PRIMARY KEY,
+    last_analytics_id BIGINT NOT NULL DEFAULT 0
+);
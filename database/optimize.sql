@@ -2,6 +2,8 @@
 CREATE INDEX IF NOT EXISTS idx_urls_is_active_created_at ON urls(is_active, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_urls_short_code_active ON urls(short_code, is_active);
 CREATE INDEX IF NOT EXISTS idx_urls_original_url ON urls(original_url(255));
+CREATE INDEX IF NOT EXISTS idx_urls_user_active_created ON urls(user_id, is_active, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_urls_user_url_hash ON urls(user_id, url_hash);
 
 ALTER TABLE urls ENGINE=InnoDB;
 
@@ -37,8 +37,7 @@ export const urlAPI = {
   },
 
   generateQRCode: async (shortCode) => {
-    const response = await api.get(`/api/qr/${shortCode}`);
-    return response.data;
+    return { qr_code: `${API_BASE_URL}/api/qr/${shortCode}` };
   },
 };
 